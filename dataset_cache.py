@@ -0,0 +1,145 @@
+"""
+Content-addressed disk cache for training datasets built from raw trajectories.
+
+A dataset built by create_dataset_traj / create_dataset_step is stored once under a key hashing
+    the raw data file contents, the builder (name and module source), which trajectories of the file were used,
+    the builder arguments (control_params, train_target, threshold, t_range, delta, ...) and the RNG seed
+and later runs with the same key memory-map it back instead of rebuilding it. The cache directory is kept
+under a size limit by evicting the least recently used datasets.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import inspect
+
+import numpy as np
+import hydra
+
+import logging
+
+log = logging.getLogger(__name__)
+
+_fingerprints = {}
+
+
+def file_fingerprint(path):
+    """
+    Returns a hash of the contents of a raw trajectory file, or of a trajectory store directory.
+    Hashes are remembered for as long as the file's size and modification time do not change
+    """
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path))
+    stat = tuple((f, os.path.getsize(f), os.path.getmtime(f)) for f in files)
+    if stat not in _fingerprints:
+        h = hashlib.sha256()
+        for f in files:
+            h.update(os.path.basename(f).encode())
+            with open(f, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1 << 24), b''):
+                    h.update(chunk)
+        _fingerprints[stat] = h.hexdigest()
+    return _fingerprints[stat]
+
+
+def dataset_key(builder, data_file, data_key=None, seed=0, **kwargs):
+    """
+    Returns the cache key of the dataset builder(data, **kwargs) built from data_file
+    """
+    key = {
+        'data': file_fingerprint(data_file),
+        'data_key': data_key,
+        'builder': '%s.%s' % (builder.__module__, builder.__qualname__),
+        # Any change to the builder's module, including its helpers, invalidates the cached datasets
+        'builder_source': hashlib.sha256(inspect.getsource(inspect.getmodule(builder)).encode()).hexdigest(),
+        'seed': seed,
+        'kwargs': kwargs,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def evict(cache_dir, max_bytes, keep=None):
+    """
+    Deletes the least recently used datasets until the cache fits in max_bytes
+    """
+    entries = [os.path.join(cache_dir, e) for e in os.listdir(cache_dir) if not e.startswith('.')]
+    entries.sort(key=os.path.getmtime)
+    total = sum(_dir_size(e) for e in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        total -= _dir_size(entry)
+        log.info("Evicting cached dataset %s" % os.path.basename(entry))
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+def cached_dataset(builder, data, data_file, cache_dir, data_key=None, seed=0, max_bytes=0, **kwargs):
+    """
+    Returns builder(data, **kwargs), from the cache if it was built before
+
+    Parameters:
+        builder: the dataset function, e.g. create_dataset_traj
+        data: the trajectories passed to builder
+        data_file: the raw trajectory file (or store) data was loaded from
+        data_key: identifies which trajectories of data_file data holds, e.g. {'split': 'train', 'num_traj': 20}
+        cache_dir: the cache directory
+        seed: seeds np.random while building, so random dataset builders are reproducible. The global random
+            state is restored afterwards, so cache hits and misses leave it the same
+        max_bytes: size limit of the cache directory, unlimited if 0
+
+    Returns:
+        (data_in, data_out), memory-mapped from the cache
+    """
+    key = dataset_key(builder, data_file, data_key=data_key, seed=seed, **kwargs)
+    entry = os.path.join(cache_dir, key)
+
+    if os.path.exists(entry):
+        log.info("Loading cached dataset %s" % key)
+    else:
+        log.info("Building dataset %s" % key)
+        state = np.random.get_state()
+        np.random.seed(seed)
+        try:
+            data_in, data_out = builder(data, **kwargs)
+        finally:
+            np.random.set_state(state)
+
+        # Written to a temporary directory first so a crash never leaves a partial entry
+        tmp = os.path.join(cache_dir, '.%s.%d' % (key, os.getpid()))
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, 'in.npy'), data_in)
+        np.save(os.path.join(tmp, 'out.npy'), data_out)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another run built the same dataset concurrently
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # The modification time of an entry records when it was last used
+    os.utime(entry)
+    if max_bytes:
+        evict(cache_dir, max_bytes, keep=entry)
+
+    return (np.load(os.path.join(entry, 'in.npy'), mmap_mode='r'),
+            np.load(os.path.join(entry, 'out.npy'), mmap_mode='r'))
+
+
+def build_dataset(cfg, builder, data, data_file, data_key=None, **kwargs):
+    """
+    Builds the dataset builder(data, **kwargs), through the cache configured in cfg.cache if it is enabled
+    and data was loaded from a file
+    """
+    if not cfg.cache.enabled or data_file is None:
+        return builder(data, **kwargs)
+    cache_dir = os.path.join(hydra.utils.get_original_cwd(), cfg.cache.dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cached_dataset(builder, data, data_file, cache_dir, data_key=data_key, seed=cfg.cache.seed,
+                          max_bytes=int(cfg.cache.max_gb * 2 ** 30), **kwargs)
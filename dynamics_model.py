@@ -1,6 +1,7 @@
 import sys
 import warnings
 import os
+import copy
 import torch
 import numpy as np
 from torch.autograd import Variable
@@ -8,7 +9,197 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 from collections import OrderedDict
-import hydra
+from contextlib import contextmanager
+
+from telemetry import Telemetry
+
+
+class Scaler(nn.Module):
+    """
+    Feature scaler with the transforms of sklearn's StandardScaler and MinMaxScaler, x * scale + shift.
+    The fitted statistics are buffers, so scaling runs on tensors inside the model and is saved with it.
+    They are accumulated one chunk at a time (with the parallel form of Welford's algorithm for the
+    variance), so large datasets can be fit in chunks.
+    """
+
+    def __init__(self, size, kind='standard', feature_range=(0., 1.)):
+        super(Scaler, self).__init__()
+        self.size = size
+        self.kind = kind
+        self.feature_range = tuple(feature_range)
+        self.register_buffer('count', torch.zeros((), dtype=torch.float64))
+        self.register_buffer('mean', torch.zeros(size, dtype=torch.float64))
+        self.register_buffer('m2', torch.zeros(size, dtype=torch.float64))
+        self.register_buffer('data_min', torch.full((size,), float('inf'), dtype=torch.float64))
+        self.register_buffer('data_max', torch.full((size,), -float('inf'), dtype=torch.float64))
+        self.register_buffer('scale', torch.ones(size))
+        self.register_buffer('shift', torch.zeros(size))
+
+    @staticmethod
+    def from_config(params, size):
+        """
+        Creates a scaler from a preprocess entry of a model config, e.g.
+            class: sklearn.preprocessing.MinMaxScaler
+            params:
+              feature_range: [-1.,1.]
+        """
+        if params['class'].endswith('MinMaxScaler'):
+            feature_range = params.get('params', {}).get('feature_range', (0., 1.))
+            return Scaler(size, 'minmax', feature_range)
+        if params['class'].endswith('StandardScaler'):
+            return Scaler(size)
+        raise ValueError("Unsupported scaler: " + params['class'])
+
+    @staticmethod
+    def from_sklearn(sk):
+        """
+        Creates a scaler from a fitted sklearn StandardScaler or MinMaxScaler
+        """
+        size = len(sk.scale_)
+        if hasattr(sk, 'data_min_'):
+            scaler = Scaler(size, 'minmax', sk.feature_range)
+            scaler.data_min.copy_(torch.from_numpy(sk.data_min_))
+            scaler.data_max.copy_(torch.from_numpy(sk.data_max_))
+            scaler.shift.copy_(torch.from_numpy(sk.min_))
+            scaler.scale.copy_(torch.from_numpy(sk.scale_))
+        else:
+            scaler = Scaler(size)
+            scaler.mean.copy_(torch.from_numpy(sk.mean_))
+            scaler.shift.copy_(torch.from_numpy(-sk.mean_ / sk.scale_))
+            scaler.scale.copy_(torch.from_numpy(1 / sk.scale_))
+        scaler.count.fill_(float(np.max(sk.n_samples_seen_)))
+        if hasattr(sk, 'var_'):
+            scaler.m2.copy_(torch.from_numpy(sk.var_) * scaler.count)
+        return scaler
+
+    def reset(self):
+        self.count.zero_()
+        self.mean.zero_()
+        self.m2.zero_()
+        self.data_min.fill_(float('inf'))
+        self.data_max.fill_(-float('inf'))
+
+    def partial_fit(self, x):
+        """
+        Updates the statistics with a chunk of data
+        """
+        x = torch.as_tensor(x, dtype=torch.float64)
+        n = x.shape[0]
+        if n == 0:
+            return self
+        mean = x.mean(0)
+        m2 = ((x - mean) ** 2).sum(0)
+
+        # Combines the statistics of the data seen so far with the chunk's
+        total = self.count + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.mean += delta * n / total
+        self.count.copy_(total)
+        self.data_min.copy_(torch.min(self.data_min, x.min(0)[0]))
+        self.data_max.copy_(torch.max(self.data_max, x.max(0)[0]))
+
+        if self.kind == 'minmax':
+            data_range = self.data_max - self.data_min
+            data_range[data_range == 0] = 1
+            scale = (self.feature_range[1] - self.feature_range[0]) / data_range
+            shift = self.feature_range[0] - self.data_min * scale
+        else:
+            std = torch.sqrt(self.m2 / self.count)
+            # Constant features are left unscaled, like sklearn does
+            std[std <= 1e-10 * torch.clamp(self.mean.abs(), min=1)] = 1
+            scale = 1 / std
+            shift = -self.mean / std
+        self.scale.copy_(scale)
+        self.shift.copy_(shift)
+        return self
+
+    def fit(self, x, chunk_size=100000):
+        self.reset()
+        for start in range(0, x.shape[0], chunk_size):
+            self.partial_fit(x[start:start + chunk_size])
+        return self
+
+    def forward(self, x):
+        return torch.addcmul(self.shift, x, self.scale)
+
+    def inverse_transform(self, y):
+        return (y - self.shift) / self.scale
+
+
+# Number of entries evaluated at once when computing test errors
+VALIDATION_CHUNK = 8192
+# Number of inputs predicted at once by DynamicsModel.predict_trajectory
+TRAJECTORY_CHUNK = 65536
+
+
+def sums_over_batch(loss_fn):
+    """
+    Whether loss_fn sums over the entries of a batch, like ProbLoss, instead of averaging like nn.MSELoss
+    """
+    return getattr(loss_fn, 'reduction', 'sum') == 'sum'
+
+
+@contextmanager
+def precision_mode(precision):
+    """
+    Runs the ops in this context in the given precision: 'fp32', or 'bf16' to autocast the matrix
+    multiplications to bfloat16 on the CPU. Parameters and gradients stay in fp32 either way
+    """
+    if precision == 'bf16':
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            yield
+    elif precision == 'fp32':
+        yield
+    else:
+        raise ValueError("Unknown precision %s" % precision)
+
+
+class EarlyStopping(object):
+    """
+    Follows the test error after each epoch, keeping a copy of the state with the lowest error so far, and
+    tells when the error has stopped improving
+    """
+
+    def __init__(self, patience=0, min_delta=0., restore_best=True):
+        """
+        :param patience: the number of epochs without improvement after which to stop, 0 never stops
+        :param min_delta: the decrease of the test error that counts as an improvement
+        :param restore_best: whether to keep a copy of the best state for restore
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+        self.restore_best = restore_best
+        self.best = float('inf')
+        self.best_epoch = -1
+        self.best_state = None
+        self.epoch = 0
+
+    @staticmethod
+    def from_config(params):
+        return EarlyStopping(params.patience, params.min_delta, params.restore_best)
+
+    def step(self, error, state):
+        """
+        Records the test error of an epoch
+
+        Parameters:
+            error: the test error
+            state: a function returning the current state, as a dictionary of tensors
+
+        Returns:
+            whether training should stop
+        """
+        if error < self.best - self.min_delta:
+            self.best = error
+            self.best_epoch = self.epoch
+            if self.restore_best:
+                self.best_state = {k: v.detach().clone() for k, v in state().items()}
+        self.epoch += 1
+        return self.stopped()
+
+    def stopped(self):
+        return 0 < self.patience <= self.epoch - self.best_epoch - 1
 
 
 class Net(nn.Module):
@@ -44,6 +235,41 @@ class Net(nn.Module):
         layers.append(('dynm_out_lin', nn.Linear(self.hidden_w, self.n_out)))
         self.features = nn.Sequential(OrderedDict([*layers]))
 
+        # Scalers for the input columns and the predicted states
+        n_states = len(self.state_indices)
+        if cfg.model.traj:
+            self.stateScaler = Scaler.from_config(cfg.model.preprocess.state, n_states)
+            self.indexScaler = Scaler.from_config(cfg.model.preprocess.index, 1)
+            self.paramScaler = Scaler.from_config(cfg.model.preprocess.param, self.n_in - n_states - 1)
+        else:
+            self.stateScaler = Scaler.from_config(cfg.model.preprocess.state, n_states)
+            self.actionScaler = Scaler.from_config(cfg.model.preprocess.action, self.n_in - n_states)
+        self.outputScaler = Scaler.from_config(cfg.model.preprocess.output, n_states)
+
+        # The precision of predictions, see precision_mode
+        self.precision = 'fp32'
+
+    def __setstate__(self, state):
+        super(Net, self).__setstate__(state)
+        self.__dict__.setdefault('precision', 'fp32')
+        # Models saved before the scalers were modules hold fitted sklearn scalers instead
+        if 'state_indices' not in state:
+            return
+        n_states = len(self.state_indices)
+        sizes = {'stateScaler': n_states, 'indexScaler': 1, 'paramScaler': self.n_in - n_states - 1,
+                 'actionScaler': self.n_in - n_states, 'outputScaler': n_states}
+        scalers = ['stateScaler', 'indexScaler', 'paramScaler'] if self.cfg.model.traj else ['stateScaler',
+                                                                                             'actionScaler']
+        for name in scalers + ['outputScaler']:
+            scaler = self.__dict__.pop(name, None)
+            if isinstance(scaler, Scaler) or name in self._modules:
+                continue
+            if scaler is None or not hasattr(scaler, 'scale_'):
+                # e.g. the action scaler of environments without actions was never fit
+                setattr(self, name, Scaler(sizes[name]))
+            else:
+                setattr(self, name, Scaler.from_sklearn(scaler))
+
     def forward(self, x):
         """
         Runs a forward pass of x through this network
@@ -53,97 +279,169 @@ class Net(nn.Module):
         x = self.features(x.float())
         return x
 
-    def testPreprocess(self, input, cfg):
-        if (cfg.model.traj):
-            inputStates = input[:, :len(self.state_indices)]
-            inputIndex = input[:, len(self.state_indices)]
-            inputParams = input[:, len(self.state_indices) + 1:]
-
-            inputIndex = inputIndex.reshape(-1, 1)
+    def input_scalers(self):
+        """
+        The scalers of the input columns, in order
+        """
+        if self.cfg.model.traj:
+            return [self.stateScaler, self.indexScaler, self.paramScaler]
+        return [self.stateScaler, self.actionScaler]
 
-            normStates = self.stateScaler.transform(inputStates)
-            normIndex = self.indexScaler.transform(inputIndex)
-            normParams = self.paramScaler.transform(inputParams)
-            return np.hstack((normStates, normIndex, normParams))
-        else:
-            inputStates = input[:, cfg.model.training.state_indices]
-            normStates = self.stateScaler.transform(inputStates)
-            if cfg.env.action_size > 0:
-                inputActions = input[:, len(self.state_indices):]
-                normActions = self.actionScaler.transform(inputActions)
-                normInput = np.hstack((normStates, normActions))
-                return normInput
-            else:
-                normInput = normStates
-                return normInput
+    def testPreprocess(self, input, cfg=None):
+        """
+        Normalizes raw inputs. The input scalers are applied as one fused affine op
+        """
+        scalers = self.input_scalers()
+        scale = torch.cat([s.scale for s in scalers])
+        shift = torch.cat([s.shift for s in scalers])
+        return torch.addcmul(shift, torch.as_tensor(input, dtype=scale.dtype), scale)
 
     def testPostprocess(self, output):
-        return torch.from_numpy(self.outputScaler.inverse_transform(output.detach().numpy()))
+        return self.outputScaler.inverse_transform(output)
 
-    def preprocess(self, dataset, cfg):
+    def predict(self, x):
+        """
+        Predicts raw states from raw inputs, with normalization and de-normalization in the graph
+        """
+        with precision_mode(self.precision):
+            output = self.forward(self.testPreprocess(x))
+        return self.testPostprocess(output[:, :len(self.state_indices)].float())
+
+    def fit_scalers(self, dataset):
+        """
+        Fits the scalers to dataset, a tuple of input and output arrays or SubsetViews
+        """
+        input = dataset[0]
+        output = dataset[1]
+
+        start = 0
+        for scaler in self.input_scalers():
+            scaler.fit(input[:, start:start + scaler.size])
+            start += scaler.size
+        self.outputScaler.fit(output)
 
-        # Select scaling, minmax vs standard (fits to a gaussian with unit variance and 0 mean)
-        # TODO: Selection should be in config
-        # StandardScaler, MinMaxScaler
-        # TODO: Instead of hardcoding, include in config, trajectory vs. one-step, length of different inputs, etc.
-        # 26 -> one-step, 37 -> trajectory
+    def update_scalers(self, dataset, chunk_size=100000):
+        """
+        Updates the scalers with the statistics of dataset, a tuple of input and output arrays or SubsetViews,
+        on top of the data they were fit on before. The first and last layers are adjusted so the net still
+        predicts the same raw outputs from the same raw inputs
+        """
         input = dataset[0]
         output = dataset[1]
-        if (cfg.model.traj):
-            self.stateScaler = hydra.utils.instantiate(cfg.model.preprocess.state)
-            self.indexScaler = hydra.utils.instantiate(cfg.model.preprocess.index)
-            self.paramScaler = hydra.utils.instantiate(cfg.model.preprocess.param)
-            self.outputScaler = hydra.utils.instantiate(cfg.model.preprocess.output)
-
-            inputStates = input[:, :len(self.state_indices)]
-            inputIndex = input[:, len(self.state_indices)]
-            inputParams = input[:, len(self.state_indices) + 1:]
-
-            # reshape index for one feature length
-            inputIndex = inputIndex.reshape(-1, 1)
-
-            self.stateScaler.fit(inputStates)
-            self.indexScaler.fit(inputIndex)
-            self.paramScaler.fit(inputParams)
-            self.outputScaler.fit(output)
-
-            normStates = self.stateScaler.transform(inputStates)
-            normIndex = self.indexScaler.transform(inputIndex)
-            normParams = self.paramScaler.transform(inputParams)
-            normOutput = self.outputScaler.transform(output)
-            normInput = np.hstack((normStates, normIndex, normParams))
-            return list(zip(normInput, normOutput))
-        else:
-            self.stateScaler = hydra.utils.instantiate(cfg.model.preprocess.state)
-            self.actionScaler = hydra.utils.instantiate(cfg.model.preprocess.action)
-            self.outputScaler = hydra.utils.instantiate(cfg.model.preprocess.output)
 
-            inputStates = input[:, :len(self.state_indices)]
-            inputActions = input[:, len(self.state_indices):]
+        scalers = self.input_scalers()
+        in_scale = torch.cat([s.scale for s in scalers])
+        in_shift = torch.cat([s.shift for s in scalers])
+        out_scale = self.outputScaler.scale.clone()
+        out_shift = self.outputScaler.shift.clone()
 
-            self.stateScaler.fit(inputStates)
+        for chunk in range(0, len(input), chunk_size):
+            start = 0
+            for scaler in scalers:
+                scaler.partial_fit(input[:, start:start + scaler.size][chunk:chunk + chunk_size])
+                start += scaler.size
+            self.outputScaler.partial_fit(output[chunk:chunk + chunk_size])
 
-            self.outputScaler.fit(output)
-            normStates = self.stateScaler.transform(inputStates)
-            normOutput = self.outputScaler.transform(output)
+        linears = [m for m in self.features if isinstance(m, nn.Linear)]
+        first, last = linears[0], linears[-1]
+        n_states = len(self.state_indices)
+        with torch.no_grad():
+            # The old normalized inputs are the new ones times ratio, plus an offset folded into the bias
+            ratio = in_scale / torch.cat([s.scale for s in scalers])
+            first.bias += first.weight @ (in_shift - torch.cat([s.shift for s in scalers]) * ratio)
+            first.weight *= ratio
 
-            if np.shape(inputActions)[1] > 0:
-                self.actionScaler.fit(inputActions)
-                normActions = self.actionScaler.transform(inputActions)
-                normInput = np.hstack((normStates, normActions))
-            else:
-                normInput = normStates
+            # The new normalized outputs are the old ones rescaled by q and shifted
+            q = self.outputScaler.scale / out_scale
+            last.bias[:n_states] = (last.bias[:n_states] - out_shift) * q + self.outputScaler.shift
+            last.weight[:n_states] *= q.unsqueeze(1)
+            if self.n_out > n_states:
+                # Log variances of probabilistic nets
+                last.bias[n_states:] += 2 * torch.log(q)
+
+    def normalize(self, dataset, chunk_size=100000):
+        """
+        Returns dataset normalized, as contiguous float tensors of inputs and outputs. The dataset is read
+        chunk by chunk, so views are never copied as a whole
+        """
+        input = dataset[0]
+        output = dataset[1]
+        normInput = torch.empty(input.shape)
+        normOutput = torch.empty(output.shape)
+        for start in range(0, len(input), chunk_size):
+            end = start + chunk_size
+            normInput[start:end] = self.testPreprocess(input[start:end])
+            normOutput[start:end] = self.outputScaler(torch.as_tensor(output[start:end], dtype=torch.float))
+        return normInput, normOutput
+
+    def preprocess(self, dataset, cfg):
+        """
+        Fits the scalers to dataset and returns it normalized
+        """
+        self.fit_scalers(dataset)
+        return self.normalize(dataset)
+
+    def lazy_loaders(self, dataset, cfg):
+        """
+        Sets up training and test loaders for a dataset whose entries are assembled on the fly
+        (see reacher_pd.TrajectoryPairDataset). Instead of throwing data away, max_size bounds
+        the number of fresh random entries drawn from the training split every epoch.
+        """
+        bs = cfg.model.optimizer.batch
+        max_size = cfg.model.optimizer.max_size
+        n_split = int(cfg.model.optimizer.split * len(dataset))
+        n_train, n_test = n_split, len(dataset) - n_split
+        if 0 < max_size < len(dataset):
+            n_train = int(cfg.model.optimizer.split * max_size)
+            n_test = max_size - n_train
 
-            return list(zip(normInput, normOutput))
+        # Scalers are fit on a random sample of the training split
+        fit_idx = np.random.randint(0, n_split, min(n_train, 100000))
+        self.preprocess(dataset[fit_idx], cfg)
 
-    def optimize(self, dataset, cfg):
+        def transform(data):
+            inputs, outputs = data
+            return self.testPreprocess(inputs), self.outputScaler(torch.as_tensor(outputs, dtype=torch.float))
+
+        trainLoader = BatchLoader(dataset, 0, n_split, n_train, bs, transform)
+        # The test entries stay fixed so test errors are comparable between epochs
+        testLoader = BatchLoader(dataset, n_split, len(dataset), n_test, VALIDATION_CHUNK, transform, resample=False)
+        return trainLoader, testLoader
+
+    def validate(self, loader, batch_size, precision='fp32'):
         """
-        Uses dataset to train this net according to the parameters in cfg
+        Returns the error of this net on the entries of loader, scaled like the training error of batches
+        of batch_size entries. Runs without autograd and sums the loss on-tensor, so large loader batches
+        cost a single sync
+
+        Returns:
+            the error, as a 0-dim tensor, 0 if loader has no entries
+        """
+        error = torch.zeros(())
+        if loader.num_samples == 0:
+            return error
+        sums = sums_over_batch(self.loss_fn)
+        with torch.inference_mode():
+            for inputs, targets in loader:
+                with precision_mode(precision):
+                    outputs = self.forward(inputs)
+                loss = self.loss_fn(outputs.float(), targets.float())
+                error += loss if sums else loss * len(targets)
+        # A mean loss summed over the batches of batch_size, or a summed loss, divided by the number of batches
+        if sums:
+            return error / (-(-loader.num_samples // batch_size) * batch_size)
+        return error / (loader.num_samples * batch_size)
+
+    def optimize(self, dataset, cfg, telemetry=None, refit_scalers=True):
+        """
+        Uses dataset to train this net according to the parameters in cfg, recording each epoch with
+        telemetry (by default to the file configured in cfg). The scalers are fit to dataset unless
+        refit_scalers is False
         Returns:
             train_errors: a list of average errors for each epoch on the training data
             test_errors: a list of average errors for each epoch on the test data
         """
-        from torch.utils.data import DataLoader
+        from torch.utils.data import TensorDataset
 
         # Extract parameters from cfg
         lr = cfg.model.optimizer.lr
@@ -152,53 +450,377 @@ class Net(nn.Module):
         epochs = cfg.model.optimizer.epochs
 
         # Set up the optimizer and scheduler
-        # TODO: the scheduler is currently unused. Should it be doing something it isn't or removed?
+        precision = cfg.model.optimizer.precision
         optimizer = torch.optim.Adam(self.features.parameters(), lr=lr)
-        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=6, gamma=0.7)
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=cfg.model.optimizer.lr_step,
+                                                    gamma=cfg.model.optimizer.lr_gamma)
+        stopping = EarlyStopping.from_config(cfg.model.optimizer)
+        if telemetry is None:
+            telemetry = Telemetry.from_config(cfg)
 
-        # data preprocessing for normalization
-        dataset = self.preprocess(dataset, cfg)
+        if isinstance(dataset, tuple):
+            # data preprocessing for normalization. Only the rows that are trained on are normalized
+            if refit_scalers:
+                self.fit_scalers(dataset)
+            if 0 < cfg.model.optimizer.max_size < len(dataset[0]):
+                subset = np.random.permutation(len(dataset[0]))[:cfg.model.optimizer.max_size]
+                dataset = tuple(SubsetView.of(d).take(subset) for d in dataset)
+            inputs, outputs = self.normalize(dataset)
 
-        if 0 < cfg.model.optimizer.max_size < len(dataset):
-            import random
-            dataset = random.sample(dataset, cfg.model.optimizer.max_size)
-
-        # Puts it in PyTorch dataset form and then converts to DataLoader
-        trainLoader = DataLoader(dataset[:int(split * len(dataset))], batch_size=bs, shuffle=True)
-        testLoader = DataLoader(dataset[int(split * len(dataset)):], batch_size=bs, shuffle=True)
+            # Every batch is gathered from the two tensors with one index lookup
+            dataset = TensorDataset(inputs, outputs)
+            n_split = int(split * len(dataset))
+            trainLoader = BatchLoader(dataset, 0, n_split, n_split, bs)
+            testLoader = BatchLoader(dataset, n_split, len(dataset), len(dataset) - n_split, VALIDATION_CHUNK,
+                                     resample=False)
+        else:
+            trainLoader, testLoader = self.lazy_loaders(dataset, cfg)
 
         # Optimization loop
         train_errors = []
         test_errors = []
+        telemetry.start_epoch()
         for epoch in range(epochs):
             print("    Epoch %d" % (epoch + 1))
 
-            train_error = 0
-            test_error = 0
+            # Accumulated on-tensor, so the loss is read back once per epoch instead of once per batch
+            train_error = torch.zeros(())
 
             # Iterate through dataset and take gradient descent steps
-            for i, (inputs, targets) in enumerate(trainLoader):
+            for i, (inputs, targets) in enumerate(telemetry.batches(trainLoader)):
                 optimizer.zero_grad()
-                outputs = self.forward(inputs)
+                with precision_mode(precision):
+                    outputs = self.forward(inputs)
                 loss = self.loss_fn(outputs.float(), targets.float())
-                train_error += loss.item() / (len(trainLoader) * bs)
+                train_error += loss.detach()
 
                 loss.backward()
                 optimizer.step()  # Does the update
 
             # Iterate through dataset to calculate test set accuracy
-            test_error = torch.zeros(1)
-            for i, (inputs, targets) in enumerate(testLoader):
-                outputs = self.forward(inputs)
-                loss = self.loss_fn(outputs.float(), targets.float())
-                test_error += loss.item() / (len(testLoader) * bs)
+            with telemetry.validating():
+                test_error = self.validate(testLoader, bs, precision)
 
-            train_errors.append(train_error)
+            train_errors.append(train_error.item() / (len(trainLoader) * bs))
             test_errors.append(test_error.item())
+            telemetry.end_epoch(epoch + 1, train_errors[-1], test_errors[-1], lr=optimizer.param_groups[0]['lr'])
+
+            scheduler.step()
+            # Without test entries there is nothing to stop on
+            if testLoader.num_samples and stopping.step(test_errors[-1], self.features.state_dict):
+                print("    Stopping early, no improvement since epoch %d" % (stopping.best_epoch + 1))
+                break
+
+        if stopping.best_state is not None:
+            self.features.load_state_dict(stopping.best_state)
 
         return train_errors, test_errors
 
 
+class StackedNets(nn.Module):
+    """
+    The nets of an ensemble with each layer's weights stacked into ExInxOut tensors, so one batched
+    matmul (torch.baddbmm) evaluates that layer for every member. The members' scalers are stacked the
+    same way, as Ex1xSize tensors.
+    """
+
+    def __init__(self, nets):
+        super(StackedNets, self).__init__()
+        # Kept in a plain list so the nets are not submodules
+        self.nets = list(nets)
+        self.activation = nets[0].activation
+        self.n_states = len(nets[0].state_indices)
+
+        layers = [self.linears(n) for n in nets]
+        self.weights = nn.ParameterList([nn.Parameter(torch.stack([l[k].weight.detach().t() for l in layers]))
+                                         for k in range(len(layers[0]))])
+        self.biases = nn.ParameterList([nn.Parameter(torch.stack([l[k].bias.detach().unsqueeze(0) for l in layers]))
+                                        for k in range(len(layers[0]))])
+        for name in ['in_scale', 'in_shift', 'out_scale', 'out_shift']:
+            self.register_buffer(name, None)
+        self.load_scalers()
+
+    @staticmethod
+    def linears(net):
+        return [m for m in net.features if isinstance(m, nn.Linear)]
+
+    def load_scalers(self):
+        """
+        Stacks the current statistics of the members' scalers
+        """
+        self.in_scale = torch.stack([torch.cat([s.scale for s in n.input_scalers()]) for n in self.nets]).unsqueeze(1)
+        self.in_shift = torch.stack([torch.cat([s.shift for s in n.input_scalers()]) for n in self.nets]).unsqueeze(1)
+        self.out_scale = torch.stack([n.outputScaler.scale for n in self.nets]).unsqueeze(1)
+        self.out_shift = torch.stack([n.outputScaler.shift for n in self.nets]).unsqueeze(1)
+
+    def write_back(self):
+        """
+        Copies the stacked weights back into the members' nets
+        """
+        with torch.no_grad():
+            for e, n in enumerate(self.nets):
+                for k, linear in enumerate(self.linears(n)):
+                    linear.weight.copy_(self.weights[k][e].t())
+                    linear.bias.copy_(self.biases[k][e, 0])
+
+    def forward(self, x):
+        """
+        Runs a forward pass of every member, x is an ExBxn_in tensor of normalized inputs
+        """
+        for w, b in zip(list(self.weights)[:-1], list(self.biases)[:-1]):
+            x = self.activation(torch.baddbmm(b, x, w))
+        return torch.baddbmm(self.biases[-1], x, self.weights[-1])
+
+    def predict(self, x, return_var=False):
+        """
+        Predicts raw states from raw inputs x, a Bxn_in tensor, with every member at once
+
+        Returns:
+            the ExBxn_states predictions of the members, and if return_var the variances of the probabilistic
+            members' predicted Gaussians (zero for other nets)
+        """
+        # Broadcasts the inputs to every member's normalization
+        with precision_mode(self.nets[0].precision):
+            output = self.forward(torch.addcmul(self.in_shift, x.float(), self.in_scale))
+        output = output.float()
+        mean = (output[:, :, :self.n_states] - self.out_shift) / self.out_scale
+        if not return_var:
+            return mean
+        loss_fn = self.nets[0].loss_fn
+        if isinstance(loss_fn, ProbLoss):
+            var = torch.exp(loss_fn.bound_logvar(output[:, :, self.n_states:])) / self.out_scale ** 2
+        else:
+            var = torch.zeros_like(mean)
+        return mean, var
+
+    def rollout(self, states, actions, delta):
+        """
+        Rolls out from the Nxn_states initial states, taking the NxTxA actions in turn. Every step is predicted
+        from the previous prediction with the mean over members, like DynamicsModel.predict does, without
+        leaving tensors
+
+        Returns:
+            an NxTxn_states tensor of the predicted states after each action
+        """
+        predictions = []
+        for t in range(actions.shape[1]):
+            x = torch.addcmul(self.in_shift, torch.cat([states, actions[:, t]], 1), self.in_scale)
+            with precision_mode(self.nets[0].precision):
+                x = self.forward(x)
+            prediction = ((x[:, :, :self.n_states].float() - self.out_shift) / self.out_scale).mean(0)
+            if delta:
+                prediction = states + prediction
+            predictions.append(prediction)
+            states = prediction
+        return torch.stack(predictions, 1)
+
+    def member_batches(self, inputs, outputs, rows, batch_size, shuffle):
+        """
+        Yields normalized ExBxSize batches, with member e's entries taken from rows[e]. Each member's rows
+        are optionally shuffled, and shorter ones wrap around so all members' batches line up
+        """
+        n = max(len(r) for r in rows)
+        order = torch.stack([(r[torch.randperm(len(r))] if shuffle else r).repeat(-(-n // len(r)))[:n]
+                             for r in rows])
+        for b in range(0, n, batch_size):
+            idx = order[:, b:b + batch_size]
+            yield (torch.addcmul(self.in_shift, inputs[idx], self.in_scale),
+                   torch.addcmul(self.out_shift, outputs[idx], self.out_scale))
+
+    def member_state(self, e):
+        """
+        Returns the weights of member e
+        """
+        return {name: p[e] for name, p in self.named_parameters()}
+
+    def losses(self, outputs, targets):
+        return torch.stack([n.loss_fn(outputs[e].float(), targets[e]) for e, n in enumerate(self.nets)])
+
+    def optimize(self, dataset, member_rows, cfg, telemetry=None):
+        """
+        Trains all members at once, member e on the rows member_rows[e] of dataset, with one optimizer
+        step per batch for all of them. Each member fits its own scalers and splits its rows into training
+        and test data like Net.optimize does. The trained weights are written back into the nets.
+        Each epoch is recorded with telemetry, by default to the file configured in cfg.
+
+        Returns:
+            train_errors: for each member, a list of average errors for each epoch on the training data
+            test_errors: for each member, a list of average errors for each epoch on the test data
+        """
+        # Extract parameters from cfg
+        lr = cfg.model.optimizer.lr
+        bs = cfg.model.optimizer.batch
+        split = cfg.model.optimizer.split
+        epochs = cfg.model.optimizer.epochs
+        max_size = cfg.model.optimizer.max_size
+        precision = cfg.model.optimizer.precision
+
+        input, output = dataset
+        train_rows, test_rows = [], []
+        for n, rows in zip(self.nets, member_rows):
+            n.fit_scalers((input.take(rows), output.take(rows)))
+            if 0 < max_size < len(rows):
+                rows = rows[np.random.permutation(len(rows))[:max_size]]
+            n_split = int(split * len(rows))
+            train_rows.append(torch.as_tensor(rows[:n_split]))
+            test_rows.append(torch.as_tensor(rows[n_split:]))
+        self.load_scalers()
+
+        # All members gather their batches from one shared float copy of the dataset
+        inputs, outputs = as_float_tensor(input), as_float_tensor(output)
+
+        optimizer = torch.optim.Adam(self.parameters(), lr=lr)
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=cfg.model.optimizer.lr_step,
+                                                    gamma=cfg.model.optimizer.lr_gamma)
+        # Each member keeps its own best state, and training stops once none of them improves
+        stopping = [EarlyStopping.from_config(cfg.model.optimizer) for _ in self.nets]
+        if telemetry is None:
+            telemetry = Telemetry.from_config(cfg, stacked=True)
+        n_train = -(-max(len(r) for r in train_rows) // bs) * bs
+        n_test = max(len(r) for r in test_rows)
+        # Member batches need rows for every member
+        has_test = all(len(r) for r in test_rows)
+        sums = sums_over_batch(self.nets[0].loss_fn)
+
+        # Optimization loop
+        train_errors = []
+        test_errors = []
+        telemetry.start_epoch()
+        for epoch in range(epochs):
+            print("    Epoch %d" % (epoch + 1))
+
+            # Iterate through dataset and take gradient descent steps
+            train_error = torch.zeros(len(self.nets))
+            for x, y in telemetry.batches(self.member_batches(inputs, outputs, train_rows, bs, shuffle=True)):
+                optimizer.zero_grad()
+                with precision_mode(precision):
+                    predictions = self.forward(x)
+                losses = self.losses(predictions, y)
+                train_error += losses.detach() / n_train
+
+                losses.sum().backward()
+                optimizer.step()  # Does the update
+
+            # Iterate through dataset to calculate test set accuracy, which is 0 without test entries
+            test_error = torch.zeros(len(self.nets))
+            if has_test:
+                with telemetry.validating(), torch.inference_mode():
+                    for x, y in self.member_batches(inputs, outputs, test_rows, VALIDATION_CHUNK, shuffle=False):
+                        with precision_mode(precision):
+                            predictions = self.forward(x)
+                        losses = self.losses(predictions, y)
+                        test_error += losses if sums else losses * y.shape[1]
+                # Scaled like the training error, see Net.validate
+                test_error /= -(-n_test // bs) * bs if sums else n_test * bs
+
+            train_errors.append(train_error.tolist())
+            test_errors.append(test_error.tolist())
+            telemetry.end_epoch(epoch + 1, train_errors[-1], test_errors[-1], lr=optimizer.param_groups[0]['lr'])
+
+            scheduler.step()
+            # Without test entries there is nothing to stop on
+            if has_test:
+                for e, s in enumerate(stopping):
+                    s.step(test_errors[-1][e], lambda: self.member_state(e))
+            if all(s.stopped() for s in stopping):
+                print("    Stopping early, no improvement since epoch %d" % (max(s.best_epoch for s in stopping) + 1))
+                break
+
+        params = dict(self.named_parameters())
+        with torch.no_grad():
+            for e, s in enumerate(stopping):
+                if s.best_state is not None:
+                    for name, value in s.best_state.items():
+                        params[name][e] = value
+        self.write_back()
+        # Transposed to be per member, like training the members one by one
+        return [list(e) for e in zip(*train_errors)], [list(e) for e in zip(*test_errors)]
+
+
+def as_float_tensor(array, chunk_size=100000):
+    """
+    Copies an array or SubsetView into a float tensor, chunk by chunk
+    """
+    tensor = torch.empty(array.shape)
+    for start in range(0, len(array), chunk_size):
+        tensor[start:start + chunk_size] = torch.as_tensor(array[start:start + chunk_size], dtype=torch.float)
+    return tensor
+
+
+class SubsetView(object):
+    """
+    A selection of rows and columns of a 2d array, kept as index arrays instead of a copy.
+    view[a:b] gathers just those rows, so a view can be read chunk by chunk, view[:, a:b] narrows
+    the columns and take(rows) narrows the rows.
+    """
+
+    def __init__(self, array, rows=None, columns=None):
+        self.array = array
+        self.rows = None if rows is None else np.asarray(rows)
+        self.columns = None if columns is None else np.asarray(columns)
+
+    @staticmethod
+    def of(array):
+        return array if isinstance(array, SubsetView) else SubsetView(array)
+
+    @property
+    def shape(self):
+        return (self.array.shape[0] if self.rows is None else len(self.rows),
+                self.array.shape[1] if self.columns is None else len(self.columns))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def take(self, rows):
+        return SubsetView(self.array, rows if self.rows is None else self.rows[rows], self.columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, columns = key
+            if not (isinstance(rows, slice) and rows == slice(None)):
+                raise IndexError("Only columns can be selected together with all rows")
+            columns = np.arange(self.shape[1])[columns]
+            return SubsetView(self.array, self.rows, columns if self.columns is None else self.columns[columns])
+
+        rows = key if self.rows is None else self.rows[key]
+        if self.columns is None:
+            return self.array[rows]
+        if isinstance(rows, slice):
+            return self.array[rows][:, self.columns]
+        return self.array[np.ix_(rows, self.columns)]
+
+
+class BatchLoader(object):
+    """
+    Iterates over batches of random entries in [low, high) of a dataset that can be indexed with an array
+    of indices, e.g. a TensorDataset or a lazily assembled dataset. Each batch is a single gather,
+    dataset[indices], optionally passed through transform.
+    """
+
+    def __init__(self, dataset, low, high, num_samples, batch_size, transform=None, resample=True):
+        self.dataset = dataset
+        self.low = low
+        self.high = high
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.transform = transform
+        self.indices = None if resample else self.sample()
+
+    def sample(self):
+        if self.num_samples >= self.high - self.low:
+            return self.low + np.random.permutation(self.high - self.low)
+        return np.random.randint(self.low, self.high, self.num_samples)
+
+    def __len__(self):
+        return -(-self.num_samples // self.batch_size)
+
+    def __iter__(self):
+        indices = self.sample() if self.indices is None else self.indices
+        for b in range(0, len(indices), self.batch_size):
+            batch = self.dataset[indices[b:b + self.batch_size]]
+            yield batch if self.transform is None else self.transform(batch)
+
+
 class DynamicsModel(object):
     """
     Wrapper class for a general dynamics model.
@@ -243,54 +865,315 @@ class DynamicsModel(object):
 
         self.nets = [Net(self.n_in, self.n_out, cfg, self.loss_fn) for i in range(self.E)]
 
-    def predict(self, x):
+    def set_precision(self, precision):
+        """
+        Sets the precision predictions are made in, 'fp32' or 'bf16', see precision_mode
+        """
+        for n in self.nets:
+            n.precision = precision
+
+    def predict(self, x, return_std=False):
         """
-        Use the model to predict values with x as input
+        Use the model to predict values with x as input. Probabilistic models predict their means, see
+        propagate for sampling from them
         TODO: Fix hardcoding in this method
-        TODO: particle sampling approach for probabilistic model
+
+        Parameters:
+            x: the raw inputs
+            return_std: if True, the uncertainty of the predictions is returned as well, from the same forward
+                pass of the nets
+
+        Returns:
+            the predicted states, and if return_std
+            epistemic: the variance of the members' predictions, zero for single nets
+            aleatoric: the average variance the members predict, zero unless the model is probabilistic
         """
         if type(x) == np.ndarray:
             x = torch.from_numpy(x)
-        prediction = torch.zeros((x.shape[0], len(self.state_indices)))
-        for n in self.nets:
-            scaledInput = n.testPreprocess(x, self.cfg)
-            if self.prob:
-                prediction += n.testPostprocess(n.forward(scaledInput)[:, :len(self.state_indices)]) / len(self.nets)
+        with torch.no_grad():
+            if return_std:
+                means, variances = self.stacked_nets().predict(x, return_var=True)
+                prediction = means.mean(0)
+                epistemic = means.var(0, unbiased=False)
+                aleatoric = variances.mean(0)
+            elif len(self.nets) > 1:
+                # Evaluates the ensemble with one batched matmul per layer, instead of net by net
+                prediction = self.stacked_nets().predict(x).mean(0)
             else:
-                prediction += n.testPostprocess(n.forward(scaledInput)) / len(self.nets)
-        if not self.delta:
-            return prediction[:, :len(self.state_indices)]
-        else:
+                prediction = self.nets[0].predict(x)
+        if self.delta:
             # This hardcode is the state size changing. X also includes the action / index
-            return x[:, :len(self.state_indices)] + prediction
+            prediction = x[:, :len(self.state_indices)] + prediction
+        if return_std:
+            return prediction, epistemic, aleatoric
+        return prediction
+
+    def predict_trajectory(self, initial_states, params, horizons, chunk_size=TRAJECTORY_CHUNK):
+        """
+        Predicts the states of N trajectories at all horizons at once, for trajectory models. The inputs of
+        every trajectory and horizon are built as one block and predicted chunk_size inputs at a time
+
+        Parameters:
+            initial_states: Nxn_states array of the initial states, in the columns of state_indices
+            params: NxK array of the inputs following the horizon, e.g. the P, D and target parameters the
+                model takes, or None if it takes none
+            horizons: the T timesteps to predict the states at, e.g. np.arange(1, T)
+
+        Returns:
+            an NxTxn_states tensor of the predicted states
+        """
+        if not self.traj:
+            raise ValueError("Only trajectory models predict whole trajectories, not model " + self.str)
+        initial_states = np.asarray(initial_states, dtype=np.float64)
+        horizons = np.asarray(horizons, dtype=np.float64)
+        N, T = len(initial_states), len(horizons)
+
+        columns = [np.broadcast_to(initial_states[:, None], (N, T, initial_states.shape[1])),
+                   np.broadcast_to(horizons[None, :, None], (N, T, 1))]
+        if params is not None:
+            params = np.asarray(params, dtype=np.float64)
+            columns.append(np.broadcast_to(params[:, None], (N, T, params.shape[1])))
+        inputs = torch.from_numpy(np.concatenate(columns, axis=2).reshape(N * T, -1))
+
+        prediction = torch.empty((N * T, len(self.state_indices)))
+        for start in range(0, N * T, chunk_size):
+            prediction[start:start + chunk_size] = self.predict(inputs[start:start + chunk_size])
+        return prediction.reshape(N, T, -1)
+
+    def rollout(self, initial_states, actions):
+        """
+        Predicts the states of N trajectories of one-step models by feeding back each prediction, with the
+        whole loop running on tensors, see StackedNets.rollout
+
+        Parameters:
+            initial_states: Nxn_states array of the initial states, in the columns of state_indices
+            actions: NxTxA array of the actions taken
+
+        Returns:
+            an NxTxn_states tensor of the predicted states after each action
+        """
+        if self.traj:
+            raise ValueError("Trajectory models predict whole trajectories with predict_trajectory, not rollouts")
+        initial_states = torch.as_tensor(initial_states, dtype=torch.float)
+        actions = torch.as_tensor(actions, dtype=torch.float)
+        with torch.no_grad():
+            return self.stacked_nets().rollout(initial_states, actions, self.delta)
+
+    def propagate(self, initial_states, actions, particles=20, method='TS1', quantiles=None):
+        """
+        Propagates particles through the ensemble of a probabilistic one-step model like PETS (Chua et al.,
+        2018) does: every particle's next state is sampled from the Gaussian its member predicts. All particles
+        of all trajectories are evaluated as one batch, split evenly between the members
+
+        Parameters:
+            initial_states: Nxn_states array of the initial states, in the columns of state_indices
+            actions: NxTxA array of the actions taken
+            particles: the number of particles per trajectory, a multiple of the number of nets
+            method: 'TS1' assigns every particle to a random member again at each step, 'TSinf' keeps the
+                member a particle starts with for the whole trajectory
+            quantiles: optionally, the quantiles of the particles' states to compute, e.g. (.05, .5, .95)
+
+        Returns:
+            mean, var: NxTxn_states tensors of the mean and variance of the particles after each action
+            quantiles: a QxNxTxn_states tensor of the requested quantiles, or None
+        """
+        if self.traj or not self.prob:
+            raise ValueError("Particles are propagated by probabilistic one-step models, not model " + self.str)
+        if method not in ('TS1', 'TSinf'):
+            raise ValueError("Unknown propagation method: " + method)
+        if particles % self.E:
+            raise ValueError("%d particles can not be split evenly between %d nets" % (particles, self.E))
+
+        stacked = self.stacked_nets()
+        n_states = len(self.state_indices)
+        actions = torch.as_tensor(actions, dtype=torch.float)
+        N, T = actions.shape[:2]
+        # The particles of trajectory i are rows i*particles to (i+1)*particles
+        states = torch.as_tensor(initial_states, dtype=torch.float).repeat_interleave(particles, 0)
+        actions = actions.repeat_interleave(particles, 0)
+        rows = N * particles
+        if quantiles is not None:
+            quantiles = torch.as_tensor(quantiles, dtype=torch.float)
+
+        # The rows at order[e::E] are propagated by member e
+        order = torch.randperm(rows)
+        means, variances, state_quantiles = [], [], []
+        with torch.no_grad(), precision_mode(self.nets[0].precision):
+            for t in range(T):
+                if method == 'TS1':
+                    order = torch.randperm(rows)
+                x = torch.cat([states, actions[:, t]], 1)[order].view(rows // self.E, self.E, -1).transpose(0, 1)
+                output = stacked.forward(torch.addcmul(stacked.in_shift, x, stacked.in_scale)).float()
+                logvar = self.loss_fn.bound_logvar(output[:, :, n_states:])
+                sample = torch.addcmul(output[:, :, :n_states], torch.randn_like(logvar), torch.exp(logvar / 2))
+                sample = (sample - stacked.out_shift) / stacked.out_scale
+
+                next_states = torch.empty_like(states)
+                next_states[order] = sample.transpose(0, 1).reshape(rows, n_states)
+                states = states + next_states if self.delta else next_states
+
+                states_i = states.view(N, particles, n_states)
+                means.append(states_i.mean(1))
+                variances.append(states_i.var(1, unbiased=False))
+                if quantiles is not None:
+                    state_quantiles.append(torch.quantile(states_i, quantiles, dim=1))
+
+        if quantiles is not None:
+            state_quantiles = torch.stack(state_quantiles, 2)
+        else:
+            state_quantiles = None
+        return torch.stack(means, 1), torch.stack(variances, 1), state_quantiles
+
+    def stacked_nets(self):
+        """
+        Returns the nets stacked for inference, restacked only when their weights or scalers have changed
+        since the last call, e.g. by training or loading a state dict
+        """
+        # Training and loading state dicts update the tensors in place, which bumps their versions
+        cached = getattr(self, '_stacked', None)
+        if cached is None or cached[0] != self.nets or [t._version for t in cached[1]] != cached[2]:
+            tensors = [t for n in self.nets for t in list(n.parameters()) + list(n.buffers())]
+            with torch.no_grad():
+                stacked = StackedNets(self.nets)
+            self._stacked = (list(self.nets), tensors, [t._version for t in tensors], stacked)
+        return self._stacked[3]
+
+    def __getstate__(self):
+        # The stacked nets are a cache, rebuilt after loading
+        state = dict(self.__dict__)
+        state.pop('_stacked', None)
+        return state
+
+    def select_columns(self, dataset):
+        """
+        Reforms the dataset to use only the state indices requested. (data_in, data_out) arrays are wrapped in
+        SubsetViews instead of copied, so every ensemble member shares the same buffer. Lazily assembled
+        datasets copy the selected state columns of their trajectories
+        """
+        if not isinstance(dataset, tuple):
+            return dataset.select(self.state_indices)
+        columns = np.concatenate((self.state_indices, np.arange(self.cfg.env.state_size, dataset[0].shape[1])))
+        return (SubsetView(dataset[0], columns=columns),
+                SubsetView(dataset[1], columns=self.state_indices))
+
+    def update(self, dataset, cfg, replay=None):
+        """
+        Fine-tunes the trained nets on new data instead of training new ones from scratch. The scalers take in
+        the statistics of the new data incrementally, and every net then trains for update_epochs epochs,
+        at the learning rate scaled by update_lr_scale, on the new entries mixed with a random sample of
+        earlier ones (all from cfg.model.optimizer). Like in train, each member of an ensemble gets its own
+        cross validation-ish subset of the new entries, and draws its own replay sample
+
+        Parameters:
+            dataset: (data_in, data_out) built from the new trajectories
+            cfg: the configuration
+            replay: (data_in, data_out) of the data trained on before, of which cfg.model.optimizer.replay
+                entries per new entry are sampled for each net
+
+        Returns:
+            acctrain_l, acctest_l: the train and test errors of each net for each epoch of fine-tuning
+        """
+        if not isinstance(dataset, tuple) or not (replay is None or isinstance(replay, tuple)):
+            raise ValueError("Updates need datasets of (data_in, data_out) arrays, not lazily assembled ones")
+
+        params = cfg.model.optimizer
+        update_cfg = copy.deepcopy(cfg)
+        update_cfg.model.optimizer.epochs = params.update_epochs
+        update_cfg.model.optimizer.lr = params.lr * params.update_lr_scale
+        update_cfg.model.optimizer.max_size = 0
+
+        dataset = self.select_columns(dataset)
+        if replay is not None:
+            replay = self.select_columns(replay)
+
+        if self.ens:
+            from sklearn.model_selection import KFold
+            kf = KFold(n_splits=self.E)
+            member_rows = [train_idx for train_idx, test_idx in kf.split(np.arange(len(dataset[0])))]
+        else:
+            member_rows = [np.arange(len(dataset[0]))]
 
-    def train(self, dataset, cfg):
         acctest_l = []
         acctrain_l = []
+        for i, (n, rows) in enumerate(zip(self.nets, member_rows)):
+            print("  Model %d" % (i + 1))
+            new = tuple(d.take(rows) for d in dataset)
+            n.update_scalers(new)
+
+            data = tuple(d[:] for d in new)
+            if replay is not None:
+                k = min(int(params.replay * len(data[0])), len(replay[0]))
+                rows = np.sort(np.random.choice(len(replay[0]), k, replace=False))
+                data = tuple(np.concatenate((d, r.take(rows)[:])) for d, r in zip(data, replay))
+            # Net.optimize tests on the last entries, which should hold new and replayed ones alike
+            order = np.random.permutation(len(data[0]))
+            data = tuple(d[order] for d in data)
+
+            telemetry = Telemetry.from_config(cfg, model=self.str, member=i, update=True)
+            train_e, test_e = n.optimize(data, update_cfg, telemetry, refit_scalers=False)
+            acctrain_l.append(train_e)
+            acctest_l.append(test_e)
+
+        return acctrain_l, acctest_l
 
-        # The purpose of this line is to reform the dataset to use only the state indices requested
-        dataset = (np.hstack((dataset[0][:, self.state_indices],
-                              # dataset[0][:, (self.cfg.env.state_size - len(self.state_indices)):])),
-                              dataset[0][:, self.cfg.env.state_size:])),
-                   dataset[1][:, self.state_indices])
+    def train(self, dataset, cfg, processes=0):
+        """
+        Trains the nets of this model on dataset
+
+        Parameters:
+            dataset: (data_in, data_out), or a lazily assembled trajectory dataset
+            cfg: the configuration, with the optimizer settings in cfg.model.optimizer
+            processes: if more than 1, ensemble members are trained in a pool of up to this many processes
+
+        Returns:
+            acctrain_l, acctest_l: the train and test errors of each net for each epoch
+        """
+        acctest_l = []
+        acctrain_l = []
+
+        # Lazily assembled datasets are split by trajectory instead of by entry
+        lazy = not isinstance(dataset, tuple)
+        dataset = self.select_columns(dataset)
 
         from sklearn.model_selection import KFold  # for dataset
 
-        if self.ens:
+        if self.ens and processes > 1:
+            # train the members in worker processes, on the same cross validation-ish subsets
+            from parallel_training import train_members
+            kf = KFold(n_splits=self.E)
+            splits = kf.split(np.arange(dataset.num_traj if lazy else len(dataset[0])))
+            if lazy:
+                datasets = [dataset.subset(train_idx) for train_idx, test_idx in splits]
+            else:
+                datasets = [(dataset[0].take(train_idx), dataset[1].take(train_idx)) for train_idx, test_idx in splits]
+            print("  Models 1-%d in %d processes" % (self.E, min(processes, self.E)))
+            telemetries = [Telemetry.from_config(cfg, model=self.str, member=i) for i in range(self.E)]
+            acctrain_l, acctest_l = train_members(self.nets, datasets, cfg, processes, telemetries)
+        elif self.ens and cfg.model.optimizer.batched_ensemble and not lazy:
+            # train all members together, each on its own cross validation-ish subset
+            kf = KFold(n_splits=self.E)
+            member_rows = [train_idx for train_idx, test_idx in kf.split(np.arange(len(dataset[0])))]
+            print("  Models 1-%d" % self.E)
+            acctrain_l, acctest_l = StackedNets(self.nets).optimize(
+                dataset, member_rows, cfg, Telemetry.from_config(cfg, model=self.str, stacked=True))
+        elif self.ens:
             # setup cross validation-ish datasets for training ensemble
             kf = KFold(n_splits=self.E)
-            kf.get_n_splits(dataset)
+            splits = kf.split(np.arange(dataset.num_traj if lazy else len(dataset[0])))
 
             # iterate through the validation sets
-            for (i, n), (train_idx, test_idx) in zip(enumerate(self.nets), kf.split(dataset[0])):
+            for (i, n), (train_idx, test_idx) in zip(enumerate(self.nets), splits):
                 print("  Model %d" % (i + 1))
                 # only train on training data to ensure diversity
-                sub_data = (dataset[0][train_idx], dataset[1][train_idx])
-                train_e, test_e = n.optimize(sub_data, cfg)
+                if lazy:
+                    sub_data = dataset.subset(train_idx)
+                else:
+                    sub_data = (dataset[0].take(train_idx), dataset[1].take(train_idx))
+                train_e, test_e = n.optimize(sub_data, cfg, Telemetry.from_config(cfg, model=self.str, member=i))
                 acctrain_l.append(train_e)
                 acctest_l.append(test_e)
         else:
-            train_e, test_e = self.nets[0].optimize(dataset, cfg)
+            train_e, test_e = self.nets[0].optimize(dataset, cfg, Telemetry.from_config(cfg, model=self.str, member=0))
             acctrain_l.append(train_e)
             acctest_l.append(test_e)
 
@@ -312,28 +1195,19 @@ class ProbLoss(nn.Module):
         self.min_logvar = torch.nn.Parameter(
             torch.tensor(-1 * np.ones([1, size]), dtype=torch.float, requires_grad=True))
 
-    def softplus_raw(self, input):
-        # Performs the elementwise softplus on the input
-        # softplus(x) = 1/B * log(1+exp(B*x))
-        B = torch.tensor(1, dtype=torch.float)
-        return (torch.log(1 + torch.exp(input.mul_(B)))).div_(B)
-
-        # TODO: This function has been observed outputting negative values. needs fix
+    def bound_logvar(self, logvar):
+        """
+        Softly caps the predicted log variances between min_logvar and max_logvar
+        """
+        # Caps max and min log to avoid NaNs. F.softplus stays finite where log(1 + exp(x)) overflows
+        logvar = self.max_logvar - F.softplus(self.max_logvar - logvar)
+        return self.min_logvar + F.softplus(logvar - self.min_logvar)
 
     def forward(self, inputs, targets):
         # size = targets.size()[1]
         mean = inputs[:, :self.size]
-        logvar = inputs[:, self.size:]
-
-        # Caps max and min log to avoid NaNs
-        logvar = self.max_logvar - self.softplus_raw(self.max_logvar - logvar)
-        logvar = self.min_logvar + self.softplus_raw(logvar - self.min_logvar)
-
-        var = torch.exp(logvar)
+        logvar = self.bound_logvar(inputs[:, self.size:])
 
+        # sum(diff ** 2 / var) + sum(log(var)), elementwise in O(B*D) rather than as the trace of a BxB matrix
         diff = mean - targets
-        mid = torch.div(diff, var)
-        lg = torch.sum(torch.log(var))
-        out = torch.trace(torch.mm(diff, mid.t())) + lg
-        # same as torch.sum(((mean - targets) ** 2) / var) + lg
-        return out
+        return torch.sum(diff * diff * torch.exp(-logvar) + logvar)
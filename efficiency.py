@@ -1,6 +1,8 @@
 import sys
 import warnings
 import os
+import json
+import traceback
 
 import matplotlib.cbook
 
@@ -10,6 +12,7 @@ warnings.filterwarnings("ignore", category=UserWarning)
 import numpy as np
 import matplotlib.pyplot as plt
 import itertools
+from timeit import default_timer as timer
 
 import torch
 import gym
@@ -22,8 +25,12 @@ log = logging.getLogger(__name__)
 
 from plot import plot_loss, plot_evaluations, plot_evaluations_3d, setup_plotting
 from dynamics_model import DynamicsModel
-from reacher_pd import log_hyperparams, create_dataset_traj, create_dataset_step
+from reacher_pd import log_hyperparams, create_dataset_traj, create_dataset_step, \
+    create_dataset_traj_budget, stack_trajectories, TrajectoryPairDataset, model_config
 from evaluate import test_models, num_eval
+from trajectory_store import TrajectorySet, load_trajectories, trajectory_source
+from dataset_cache import build_dataset
+from parallel_training import make_pool, share
 
 
 def train(cfg, exper_data):
@@ -43,25 +50,144 @@ def train(cfg, exper_data):
 
     log_hyperparams(cfg)
 
-    if traj:
-        dataset = create_dataset_traj(subset_data, threshold=(n - 1) / n, t_range=t_range)
+    data_file = trajectory_source(hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw' + cfg.data_dir)
+    data_key = {'split': 'train', 'num_traj': n}
+    if traj and cfg.training.lazy_dataset:
+        dataset = TrajectoryPairDataset(subset_data, t_range=t_range)
+    elif traj and cfg.training.budget:
+        dataset = build_dataset(cfg, create_dataset_traj_budget, subset_data, data_file, data_key=data_key,
+                                budget=cfg.training.budget, horizons=cfg.training.horizons, t_range=t_range)
+    elif traj:
+        dataset = build_dataset(cfg, create_dataset_traj, subset_data, data_file, data_key=data_key,
+                                threshold=(n - 1) / n, t_range=t_range)
     else:
-        dataset = create_dataset_step(subset_data, delta=delta, t_range=t_range)
+        dataset = build_dataset(cfg, create_dataset_step, stack_trajectories(subset_data), data_file,
+                                data_key=data_key, delta=delta, t_range=t_range)
 
     model = DynamicsModel(cfg)
-    train_logs, test_logs = model.train(dataset, cfg)
+    train_logs, test_logs = model.train(dataset, cfg, processes=cfg.training.processes)
 
     setup_plotting({model.str: model})
     plot_loss(train_logs, test_logs, cfg, save_loc=cfg.env.name + '-' + cfg.model.str + '_' + str(n), show=False)
 
     log.info("Saving new default models")
+    f = model_file(cfg, cfg.model.str, n, t_range)
+    if not os.path.exists(os.path.dirname(f)):
+        os.makedirs(os.path.dirname(f))
+    torch.save(model, f)
+
+
+def model_file(cfg, model_type, n, t_range):
+    """
+    Returns the file train saves the model_type model trained on n trajectories of length t_range to
+    """
+    f = hydra.utils.get_original_cwd() + '/models/reacher/efficiency/'
+    if cfg.exper_dir:
+        f = f + cfg.exper_dir
+    return '%s%s/n%d_t%d.dat' % (f, model_type, n, t_range)
+
+
+def job_cost(cfg):
+    """
+    Estimates the training cost of a sweep job as the number of entries its optimizer steps through
+    """
+    n, t_range = cfg.training.num_traj, cfg.training.t_range
+    if cfg.model.traj and cfg.training.budget:
+        size = cfg.training.budget
+    elif cfg.model.traj:
+        # Each of the n trajectories keeps a fraction 1/n of its pairs
+        size = t_range * (t_range - 1) // 2
+    else:
+        size = n * t_range
+    if cfg.model.optimizer.max_size:
+        size = min(size, cfg.model.optimizer.max_size)
+    return size * cfg.model.optimizer.epochs * (cfg.model.training.E if cfg.model.ensemble else 1)
+
+
+def _sweep_job(job):
+    key, cfg, exper_data = job
+    start = timer()
+    try:
+        train(cfg, exper_data)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+        log.error("Job %s failed:\n%s" % (key, error))
+    return key, timer() - start, error
+
+
+def write_manifest(path, manifest):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def sweep(cfg, exper_data):
+    """
+    Trains every model of the grid cfg.plotting.models x num_traj x t_range that plot expects, skipping
+    the models that were already saved. The remaining jobs run in a pool of cfg.training.processes workers,
+    most expensive first, and their progress and timings are recorded in a sweep.json manifest next to the
+    models
+    """
+    model_keys, ns, t_ranges = cfg.plotting.models, cfg.plotting.num_traj, cfg.plotting.t_range
+    if type(ns) == int:
+        ns = [ns]
+    if type(t_ranges) == int:
+        t_ranges = [t_ranges]
+
+    manifest = {'jobs': {}, 'total': 0, 'completed': 0, 'failed': 0}
+    jobs = []
+    for model_type, n, t in itertools.product(model_keys, ns, t_ranges):
+        key = '%s/n%d_t%d' % (model_type, n, t)
+        if os.path.exists(model_file(cfg, model_type, n, t)):
+            manifest['jobs'][key] = {'status': 'skipped'}
+            continue
+        job_cfg = model_config(cfg, model_type)
+        job_cfg.training.num_traj = n
+        job_cfg.training.t_range = t
+        manifest['jobs'][key] = {'status': 'pending', 'cost': job_cost(job_cfg)}
+        jobs.append((key, job_cfg))
+    jobs.sort(key=lambda job: manifest['jobs'][job[0]]['cost'], reverse=True)
+    manifest['total'] = len(jobs)
+
     f = hydra.utils.get_original_cwd() + '/models/reacher/efficiency/'
     if cfg.exper_dir:
         f = f + cfg.exper_dir
-    f = f + cfg.model.str
     if not os.path.exists(f):
         os.makedirs(f)
-    torch.save(model, '%s/n%d_t%d.dat'%(f, n, t_range))
+    manifest_file = os.path.join(f, 'sweep.json')
+    write_manifest(manifest_file, manifest)
+    log.info("Sweep of %d jobs, %d already trained" % (len(jobs), len(manifest['jobs']) - len(jobs)))
+
+    def record(result):
+        key, seconds, error = result
+        entry = manifest['jobs'][key]
+        entry['status'] = 'failed' if error else 'finished'
+        entry['seconds'] = seconds
+        if error:
+            entry['error'] = error
+            manifest['failed'] += 1
+        manifest['completed'] += 1
+        write_manifest(manifest_file, manifest)
+        log.info("Finished %s in %.1fs (%d/%d)" % (key, seconds, manifest['completed'], manifest['total']))
+
+    processes = min(cfg.training.processes, len(jobs))
+    if processes > 1:
+        if isinstance(exper_data, TrajectorySet):
+            # The workers read the trajectories from shared memory (or the store's files) instead of copies
+            memo = {}
+            exper_data = TrajectorySet({name: share(column, memo) for name, column in exper_data.columns.items()},
+                                       exper_data.indices)
+        for _, job_cfg in jobs:
+            # Workers cannot start pools of their own
+            job_cfg.training.processes = 0
+        with make_pool(processes) as pool:
+            for result in pool.imap_unordered(_sweep_job, [(key, job_cfg, exper_data) for key, job_cfg in jobs]):
+                record(result)
+    else:
+        for key, job_cfg in jobs:
+            record(_sweep_job((key, job_cfg, exper_data)))
 
 
 def plot(cfg, train_data, test_data):
@@ -239,11 +365,13 @@ def plot(cfg, train_data, test_data):
 def eff(cfg):
 
     log.info(f"Loading default data")
-    (train_data, test_data) = torch.load(
+    (train_data, test_data) = load_trajectories(
         hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw' + cfg.data_dir)
 
     if cfg.mode == 'train':
         train(cfg, train_data)
+    elif cfg.mode == 'sweep':
+        sweep(cfg, train_data)
     elif cfg.mode == 'plot':
         plot(cfg, train_data, test_data)
 
@@ -3,6 +3,8 @@ The purpose of this file is to load in pre-loaded data and pre-trained models an
 """
 
 import sys
+import json
+from timeit import default_timer as timer
 
 import hydra
 import logging
@@ -11,6 +13,7 @@ import torch
 import numpy as np
 
 from plot import *
+from trajectory_store import load_trajectories
 
 log = logging.getLogger(__name__)
 
@@ -62,30 +65,33 @@ def test_models(test_data, models):
     # eval_indices = list(set.intersection(*[models[key].state_indices for key in models]))
     # eval_indices.sort()
 
+    # Make predictions on all trajectories and timesteps at once. Trajectory models predict every timestep
+    # directly, one-step models roll out from their own predictions
+    trajectories = {}
+    for key in models:
+        model = models[key]
+        if model.traj:
+            params = []
+            if model.control_params:
+                params.extend([P_param, D_param])
+            if model.train_target:
+                params.append(target)
+            params = np.hstack(params) if params else None
+            trajectories[key] = model.predict_trajectory(initials[:, model.state_indices], params,
+                                                         np.arange(1, T)).numpy()
+        else:
+            trajectories[key] = model.rollout(initials[:, model.state_indices], actions[:, :T - 1]).numpy()
+
     # Iterate through each type of model for evaluation
     predictions = {key: [states[:, 0, models[key].state_indices]] for key in models}
-    currents = {key: states[:, 0, models[key].state_indices] for key in models}
     for i in range(1, T):
         groundtruth = states[:, i]
         for key in models:
-            model = models[key]
-            indices = model.state_indices
-            traj = model.traj
-            # Make predictions on all trajectories at once
-            if traj:
-                dat = [initials[:, indices], i * np.ones((N, 1))]
-                if model.control_params:
-                    dat.extend([P_param, D_param])
-                if model.train_target:
-                    dat.append(target)
-                prediction = np.array(model.predict(np.hstack(dat)).detach())
-            else:
-                prediction = model.predict(np.hstack((currents[key], actions[:, i - 1, :])))
-                prediction = np.array(prediction.detach())
+            indices = models[key].state_indices
+            prediction = trajectories[key][:, i - 1]
 
             predictions[key].append(prediction)
             MSEs[key].append(np.square(groundtruth[:, indices] - prediction.squeeze()).mean(axis=1))
-            currents[key] = prediction.squeeze()
 
     MSEs = {key: np.array(MSEs[key]).transpose() for key in MSEs}
     if N > 1:
@@ -97,6 +103,49 @@ def test_models(test_data, models):
     return MSEs, predictions
 
 
+def precision_report(test_data, models, precisions=('fp32', 'bf16')):
+    """
+    Compares the predictions of the models in different precisions against the first one, by running
+    test_models in each of them
+
+    Parameters:
+    ------------
+    test_data: the trajectories to test on
+    models: a dictionary of DynamicsModels to test
+    precisions: the precisions to compare, see dynamics_model.precision_mode
+
+    Returns:
+     report:    report[key][precision] holds, for model 'key', the average MSE of the predictions at each
+                    time step ('mse'), the predicted states per second ('throughput'), the throughput
+                    relative to the first precision ('speedup') and the largest absolute and relative
+                    differences of the MSE curve from the first precision's ('max_abs_diff', 'max_rel_diff')
+    """
+    report = {key: {} for key in models}
+    N, T = len(test_data), len(test_data[0].states)
+    for key, model in models.items():
+        for precision in precisions:
+            model.set_precision(precision)
+            start = timer()
+            MSEs, _ = test_models(test_data, {key: model})
+            elapsed = timer() - start
+
+            mse = np.mean(MSEs[key], axis=0)
+            report[key][precision] = {'mse': mse.tolist(), 'throughput': N * (T - 1) / elapsed}
+        model.set_precision(precisions[0])
+
+        base = report[key][precisions[0]]
+        for precision in precisions:
+            entry = report[key][precision]
+            diff = np.abs(np.array(entry['mse']) - np.array(base['mse']))
+            entry['speedup'] = entry['throughput'] / base['throughput']
+            entry['max_abs_diff'] = float(np.max(diff))
+            entry['max_rel_diff'] = float(np.max(diff / np.maximum(np.array(base['mse']), 1e-12)))
+            log.info("%s %s: mean MSE %.4g, %.0f states/s (x%.2f), max MSE difference %.3g (%.2f%%)"
+                     % (key, precision, np.mean(entry['mse']), entry['throughput'], entry['speedup'],
+                        entry['max_abs_diff'], 100 * entry['max_rel_diff']))
+    return report
+
+
 def test_traj_ensemble(ensemble, test_data):
     """
     TODO: decide if this is useful or remove
@@ -223,7 +272,7 @@ def evaluate(cfg):
 
     # Load test data
     log.info(f"Loading default data")
-    (train_data, test_data) = torch.load(
+    (train_data, test_data) = load_trajectories(
         hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw' + cfg.data_dir)
 
     # Load models
@@ -236,6 +285,12 @@ def evaluate(cfg):
     for model_type in model_types:
         models[model_type] = torch.load(f + model_type + ".dat")
 
+    if cfg.precision_report:
+        log.info("Comparing prediction precisions")
+        report = precision_report(test_data, models)
+        with open('precision_report.json', 'w') as fp:
+            json.dump(report, fp, indent=2)
+
     # Plot
     def plot_helper(data, num, graph_file):
         """
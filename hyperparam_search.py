@@ -0,0 +1,187 @@
+"""
+Successive halving search over the hyperparameters of a model configuration.
+
+Configurations are sampled from search.space in conf/search.yaml around the selected model, e.g.
+    python hyperparam_search.py models=tp search.num_configs=27
+Every round trains the surviving configurations in parallel up to the round's number of epochs, scores them
+on entries of the test trajectories and keeps the best 1/eta of them for the next round, which trains eta
+times as many epochs. Survivors keep their weights between rounds, but every round trains them with a new
+optimizer, so the learning rate schedule and early stopping start over each round, from the round's first
+epoch. The run directory ends up with
+    search_results.csv    the score of every configuration in every round it took part in, with the epochs
+                          trained in total and in that round
+    best_<model>.yaml     the best model configuration, in the format of conf/models
+"""
+
+import sys
+import warnings
+import copy
+import csv
+
+import matplotlib.cbook
+
+warnings.filterwarnings("ignore", category=matplotlib.cbook.mplDeprecation)
+warnings.filterwarnings("ignore", category=UserWarning)
+
+import numpy as np
+from timeit import default_timer as timer
+from omegaconf import OmegaConf
+
+import hydra
+import logging
+
+log = logging.getLogger(__name__)
+
+from dynamics_model import DynamicsModel, SubsetView
+from reacher_pd import training_dataset
+from trajectory_store import load_trajectories, trajectory_source
+from parallel_training import make_pool, share
+
+
+def sample_config(cfg, space, rng):
+    """
+    Returns a copy of cfg with the model settings in space sampled with the RandomState rng
+
+    Returns:
+        the configuration, and a dictionary of the sampled values
+    """
+    sampled_cfg = copy.deepcopy(cfg)
+    values = {}
+    for path, choices in space.items():
+        if 'log_uniform' in choices:
+            low, high = choices.log_uniform
+            value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        elif 'uniform' in choices:
+            low, high = choices.uniform
+            value = float(rng.uniform(low, high))
+        else:
+            value = choices[rng.randint(len(choices))]
+        node = sampled_cfg.model
+        keys = path.split('.')
+        for key in keys[:-1]:
+            node = node[key]
+        node[keys[-1]] = value
+        values[path] = value
+    return sampled_cfg, values
+
+
+def validation_error(model, val):
+    """
+    Returns the mean squared error of the states model predicts for the entries of val, (data_in, data_out)
+    arrays. Unlike the logged test errors it does not depend on the batch size
+    """
+    data_in, data_out = model.select_columns(val)
+    data_in, data_out = data_in[:], data_out[:]
+    prediction = model.predict(data_in).numpy()
+    if model.delta:
+        # Deltas are predicted, and added to the current state
+        data_out = data_out + data_in[:, :len(model.state_indices)]
+    return float(np.mean((prediction - data_out) ** 2))
+
+
+def _train_config(job):
+    model, cfg, dataset, val, epochs = job
+    start = timer()
+    if model is None:
+        model = DynamicsModel(cfg)
+    # Later rounds train the previous round's weights for the remaining epochs, with a new optimizer and
+    # learning rate schedule
+    cfg = copy.deepcopy(cfg)
+    cfg.model.optimizer.epochs = epochs
+    model.train(dataset, cfg)
+    return model, validation_error(model, val), timer() - start
+
+
+def successive_halving(cfg, dataset, val):
+    """
+    Runs the search configured in cfg.search
+
+    Parameters:
+        cfg: the configuration, with the model to search around in cfg.model
+        dataset: the training dataset
+        val: (data_in, data_out) entries the configurations are scored on
+
+    Returns:
+        the best configuration, and the rows of the results table
+    """
+    params = cfg.search
+    rng = np.random.RandomState(params.seed)
+    configs = [sample_config(cfg, params.space, rng) for _ in range(params.num_configs)]
+    survivors = list(range(len(configs)))
+    models = [None] * len(configs)
+    trained = [0] * len(configs)
+
+    processes = cfg.training.processes
+    memo = {}
+    if processes > 1:
+        dataset, val = share(dataset, memo), share(val, memo)
+
+    results = []
+    epochs = params.min_epochs
+    for r in range(sys.maxsize):
+        log.info("Round %d: training %d configurations to %d epochs" % (r + 1, len(survivors), epochs))
+        jobs = [(models[i], configs[i][0], dataset, val, epochs - trained[i]) for i in survivors]
+        if processes > 1:
+            with make_pool(min(processes, len(jobs))) as pool:
+                outcomes = pool.map(_train_config, jobs, chunksize=1)
+        else:
+            outcomes = [_train_config(job) for job in jobs]
+
+        scores = {}
+        for i, (model, score, seconds) in zip(survivors, outcomes):
+            results.append(dict(configs[i][1], config=i, round=r + 1, epochs=epochs, round_epochs=epochs - trained[i],
+                                val_mse=score, seconds=seconds))
+            models[i], trained[i], scores[i] = model, epochs, score
+
+        survivors.sort(key=lambda i: scores[i])
+        if len(survivors) == 1 or epochs >= params.max_epochs:
+            break
+        # The others are dropped, and their models freed
+        for i in survivors[max(1, len(survivors) // params.eta):]:
+            models[i] = None
+        survivors = survivors[:max(1, len(survivors) // params.eta)]
+        epochs = min(epochs * params.eta, params.max_epochs)
+
+    best = survivors[0]
+    best_cfg = copy.deepcopy(configs[best][0])
+    best_cfg.model.optimizer.epochs = trained[best]
+    return best_cfg, results
+
+
+def write_results(results, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+@hydra.main(config_path='conf/search.yaml')
+def search(cfg):
+    log.info(f"Loading default data")
+    raw = hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw' + cfg.data_dir
+    (train_data, test_data) = load_trajectories(raw)
+
+    dataset = training_dataset(cfg, train_data, trajectory_source(raw))
+    val = training_dataset(cfg, test_data)
+    rows = np.random.RandomState(cfg.search.seed).permutation(len(val[0]) if isinstance(val, tuple) else len(val))
+    rows = np.sort(rows[:cfg.search.num_val])
+    if isinstance(val, tuple):
+        val = tuple(SubsetView.of(v).take(rows)[:] for v in val)
+    else:
+        val = val[rows]
+
+    log.info(f"Searching {cfg.search.num_configs} configurations of model {cfg.model.str}")
+    best_cfg, results = successive_halving(cfg, dataset, val)
+
+    write_results(results, 'search_results.csv')
+    with open('best_%s.yaml' % cfg.model.str, 'w') as f:
+        f.write(OmegaConf.create({'model': best_cfg.model}).pretty())
+
+    log.info("Results (config, round, epochs, validation MSE):")
+    for row in sorted(results, key=lambda r: (-r['round'], r['val_mse'])):
+        log.info("  %3d  %d  %3d  %.5g  %s" % (row['config'], row['round'], row['epochs'], row['val_mse'],
+                                              {k: row[k] for k in cfg.search.space}))
+
+
+if __name__ == '__main__':
+    sys.exit(search())
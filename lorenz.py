@@ -11,6 +11,7 @@ from dotmap import DotMap
 import logging
 from plot import plot_lorenz, plot_mse, plot_mse_err, plot_states
 from evaluate import test_models
+from trajectory_store import load_trajectories
 
 # adapeted from https://scipython.com/blog/the-lorenz-attractor/
 log = logging.getLogger(__name__)
@@ -69,7 +70,7 @@ def lorenz(cfg):
             torch.save((data_Seq), hydra.utils.get_original_cwd() + '/trajectories/lorenz/' + 'raw' + cfg.data_dir)
             log.info(f"Saved trajectories to {cfg.data_dir}")
     else:
-        data_Seq = torch.load(hydra.utils.get_original_cwd() + '/trajectories/lorenz/' + 'raw' + cfg.data_dir)
+        data_Seq = load_trajectories(hydra.utils.get_original_cwd() + '/trajectories/lorenz/' + 'raw' + cfg.data_dir)
 
     # Analysis
     from dynamics_model import DynamicsModel
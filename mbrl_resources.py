@@ -1,3 +1,4 @@
+import os
 import numpy as np
 from dotmap import DotMap
 
@@ -19,6 +20,9 @@ import hydra
 import logging
 
 import multiprocessing as mp
+from parallel_training import make_pool, share
+from dynamics_model import ProbLoss
+from telemetry import Telemetry
 
 log = logging.getLogger(__name__)
 
@@ -145,45 +149,6 @@ class Net(nn.Module):
             return self.testPostprocess(output)
 
 
-class ProbLoss(nn.Module):
-    """
-    Class for probabilistic loss function
-    """
-
-    def __init__(self, size):
-        super(ProbLoss, self).__init__()
-        self.size = size
-        self.max_logvar = torch.nn.Parameter(
-            torch.tensor(1 * np.ones([1, size]), dtype=torch.float, requires_grad=True))
-        self.min_logvar = torch.nn.Parameter(
-            torch.tensor(-1 * np.ones([1, size]), dtype=torch.float, requires_grad=True))
-
-    def softplus_raw(self, input):
-        # Performs the elementwise softplus on the input
-        # softplus(x) = 1/B * log(1+exp(B*x))
-        B = torch.tensor(1, dtype=torch.float)
-        return (torch.log(1 + torch.exp(input.mul_(B)))).div_(B)
-
-        # TODO: This function has been observed outputting negative values. needs fix
-
-    def forward(self, inputs, targets):
-        # size = targets.size()[1]
-        mean = inputs[:, :self.size]
-        logvar = inputs[:, self.size:]
-
-        # Caps max and min log to avoid NaNs
-        logvar = self.max_logvar - self.softplus_raw(self.max_logvar - logvar)
-        logvar = self.min_logvar + self.softplus_raw(logvar - self.min_logvar)
-
-        var = torch.exp(logvar)
-
-        diff = mean - targets
-        mid = diff / var
-        lg = torch.sum(torch.log(var))
-        out = torch.trace(torch.mm(diff, mid.t())) + lg
-        return out
-
-
 class Ensemble:
     """
     A neural network ensemble
@@ -231,11 +196,12 @@ class Ensemble:
 
         # Training
         if parallel:
-            n = mp.cpu_count()
-            pool = mp.Pool(n)
-            wrapper = lambda i: train_network(datasets[i], self.models[i], cfg, parameters=parameters)
-            ugh = list(range(n))
-            pool.map(wrapper, ugh)
+            # Trained copies of the models come back from the workers and replace the originals
+            memo = {}
+            jobs = [(share(datasets[i], memo), self.models[i], cfg, parameters) for i in range(n)]
+            with make_pool(min(n, mp.cpu_count())) as pool:
+                results = pool.map(_train_member, jobs, chunksize=1)
+            self.models = [model for model, logs in results]
         else:
             for i in range(n):
                 train_network(datasets[i], self.models[i], cfg, parameters=parameters)
@@ -243,6 +209,11 @@ class Ensemble:
         return self
 
 
+def _train_member(job):
+    dataset, model, cfg, parameters = job
+    return train_network(dataset, model, cfg, parameters=parameters)
+
+
 class Model(object):
     """
     A wrapper class for general models, including single nets and ensembles
@@ -314,16 +285,20 @@ def train_network(dataset, model, cfg, parameters=DotMap()):
     p.verbosity = parameters.get('verbosity', 1)
     p.logs = parameters.get('logs', None)
     p.evaluator = parameters.get('evaluator', None)  # A function to run on the model every 25 batches
+    p.telemetry = parameters.get('telemetry', None)  # A file to append per-epoch telemetry records to
 
     # Init logs
     if p.logs is None:
         logs = DotMap()
         logs.training_error = []
         logs.training_error_epoch = []
+        logs.test_error_epoch = []
         logs.evaluations = []
         logs.time = None
     else:
         logs = p.logs
+        if 'test_error_epoch' not in logs:
+            logs.test_error_epoch = []
 
     # Optimizer
     optimizer = p.opt.optimizer(model.parameters(), lr=p.learning_rate)
@@ -366,7 +341,9 @@ def train_network(dataset, model, cfg, parameters=DotMap()):
     dataset = list(zip(scaled_input, scaled_output))
     split = cfg.model.optimizer.split
     trainLoader = DataLoader(dataset[:int(split * len(dataset))], batch_size=p.opt.batch_size, shuffle=True)
-    testLoader = DataLoader(dataset[int(split * len(dataset)):], batch_size=p.opt.batch_size, shuffle=True)
+    # Test entries are only evaluated, so they are read in order and in large chunks
+    testLoader = DataLoader(dataset[int(split * len(dataset)):], batch_size=8192, shuffle=False)
+    n_test = len(dataset) - int(split * len(dataset))
     # loader = DataLoader(dataset, batch_size=p.opt.batch_size, shuffle=True)  ##shuffle=True #False
     # pin_memory=True
     # drop_last=False
@@ -374,13 +351,16 @@ def train_network(dataset, model, cfg, parameters=DotMap()):
     startTime = timer()
     if logs.time is None:
         logs.time = [0]
+    # logs.time holds the training time elapsed after each batch, continuing from earlier calls
+    timeOffset = logs.time[-1]
+    telemetry = Telemetry(os.path.abspath(p.telemetry) if p.telemetry else None, model='mbrl')
 
     # print("Training for %d epochs" % p.opt.n_epochs)
 
     for epoch in range(p.opt.n_epochs):
         epoch_error = 0
         log.info("Epoch %d" % (epoch))
-        for i, (inputs, targets) in enumerate(trainLoader):
+        for i, (inputs, targets) in enumerate(telemetry.batches(trainLoader)):
             if i % 500 == 0 and i > 0:
                 print("    Batch %d" % i)
             # Load data
@@ -404,20 +384,27 @@ def train_network(dataset, model, cfg, parameters=DotMap()):
 
             loss.backward()
             optimizer.step()  # Does the update
-            logs.time.append(timer() - logs.time[-1])
+            logs.time.append(timeOffset + timer() - startTime)
 
             if p.evaluator is not None and i % 25 == 0:
                 logs.evaluations.append(p.evaluator(model))
 
-        test_error = torch.zeros(1)
-        for i, (inputs, targets) in enumerate(testLoader):
-            outputs = model.forward(inputs.float())
-            loss = p.criterion(outputs, targets)
-
-            test_error += loss.item() / (len(testLoader) * p.opt.batch_size)
-        test_error = test_error
+        # Accumulated on-tensor without autograd, and scaled like the training error of batch_size batches
+        test_error = torch.zeros(())
+        sums = getattr(p.criterion, 'reduction', 'sum') == 'sum'
+        with telemetry.validating(), torch.inference_mode():
+            for i, (inputs, targets) in enumerate(testLoader):
+                if p.useGPU:
+                    inputs, targets = inputs.cuda(), targets.cuda()
+                outputs = model.forward(inputs.float())
+                loss = p.criterion(outputs, targets.float())
+                test_error += (loss if sums else loss * len(targets)).cpu()
+        n_batches = -(-n_test // p.opt.batch_size)
+        test_error /= n_batches * p.opt.batch_size if sums else n_test * p.opt.batch_size
 
         logs.training_error_epoch.append(epoch_error)
+        logs.test_error_epoch.append(test_error.item())
+        telemetry.end_epoch(epoch + 1, epoch_error, logs.test_error_epoch[-1], lr=p.learning_rate)
 
     endTime = timer()
     log.info('Optimization completed in %f[s]' % (endTime - startTime))
@@ -0,0 +1,167 @@
+"""
+Process-pool training of ensemble members, and of several models at once.
+
+The training data is moved to shared memory once (memory-mapped arrays, e.g. cached datasets, are simply
+reopened from their file) and workers attach to it instead of each receiving a pickled copy. Every worker
+limits torch to its share of the cores so the pool does not oversubscribe them, and sends the trained
+weights back to the parent, which loads them into its own nets.
+"""
+
+import os
+import mmap
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class SharedArray(np.ndarray):
+    """
+    An array in shared memory, or memory-mapped from a file, that pickles as a handle to that memory
+    """
+
+    def __array_finalize__(self, obj):
+        # Slices and other arrays derived from a shared array are pickled as regular copies
+        self.handle = None
+
+    def __reduce__(self):
+        if self.handle is None:
+            return np.asarray(self).__reduce__()
+        return _attach, (self.handle,)
+
+
+def _attach(handle):
+    kind, value = handle
+    if kind == 'file':
+        filename, dtype, shape, offset = value
+        return np.memmap(filename, dtype=dtype, mode='r', shape=tuple(shape), offset=offset)
+    return value.numpy()
+
+
+def shared_array(array):
+    """
+    Returns array as a SharedArray, copying it to shared memory unless it is memory-mapped from a file
+    """
+    if isinstance(array, SharedArray) and array.handle is not None:
+        return array
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.flags.c_contiguous:
+        handle = ('file', (array.filename, array.dtype.str, array.shape, array.offset))
+        shared = np.asarray(array).view(SharedArray)
+    else:
+        tensor = torch.from_numpy(np.require(array, requirements=['C', 'W'])).share_memory_()
+        handle = ('tensor', tensor)
+        shared = tensor.numpy().view(SharedArray)
+    shared.handle = handle
+    return shared
+
+
+def share(dataset, memo=None):
+    """
+    Moves the arrays of dataset to shared memory
+
+    Parameters:
+        dataset: an array, a SubsetView or a tuple of those, e.g. (data_in, data_out). Other datasets, like
+            lazily assembled trajectory datasets, are returned as is and pickled to the workers
+        memo: maps the ids of arrays shared before to their shared copies, so datasets built from the
+            same arrays share one copy
+    """
+    from dynamics_model import SubsetView
+
+    memo = {} if memo is None else memo
+    if isinstance(dataset, tuple):
+        return tuple(share(d, memo) for d in dataset)
+    if isinstance(dataset, SubsetView):
+        return SubsetView(share(dataset.array, memo), dataset.rows, dataset.columns)
+    if isinstance(dataset, np.ndarray):
+        if id(dataset) not in memo:
+            memo[id(dataset)] = (dataset, shared_array(dataset))
+        return memo[id(dataset)][1]
+    return dataset
+
+
+def worker_threads(processes):
+    """
+    Returns the number of torch threads of each of processes workers
+    """
+    return max(1, (os.cpu_count() or 1) // processes)
+
+
+def _init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def make_pool(processes):
+    """
+    Returns a pool of processes workers that split the cores between them
+    """
+    return mp.Pool(processes, initializer=_init_worker, initargs=(worker_threads(processes),))
+
+
+def _train_member(job):
+    net, dataset, cfg, telemetry = job
+    train_e, test_e = net.optimize(dataset, cfg, telemetry)
+    return net.state_dict(), train_e, test_e
+
+
+def train_members(nets, datasets, cfg, processes, telemetries=None):
+    """
+    Trains each net on its dataset with net.optimize, in parallel
+
+    Parameters:
+        nets: the ensemble members
+        datasets: the dataset of each member, e.g. views of one shared dataset
+        cfg: the configuration passed to net.optimize
+        processes: the maximum number of worker processes
+        telemetries: the Telemetry of each member, by default the one configured in cfg
+
+    Returns:
+        train_errors, test_errors: the errors of each member, as returned by net.optimize
+    """
+    memo = {}
+    telemetries = telemetries or [None] * len(nets)
+    jobs = [(net, share(dataset, memo), cfg, telemetry)
+            for net, dataset, telemetry in zip(nets, datasets, telemetries)]
+    with make_pool(min(processes, len(jobs))) as pool:
+        results = pool.map(_train_member, jobs, chunksize=1)
+
+    for net, (state, _, _) in zip(nets, results):
+        net.load_state_dict(state)
+    return [r[1] for r in results], [r[2] for r in results]
+
+
+def _train_model(job):
+    model, dataset, cfg = job
+    train_logs, test_logs = model.train(dataset, cfg)
+    return [n.state_dict() for n in model.nets], train_logs, test_logs
+
+
+def train_models(models, datasets, cfgs, processes):
+    """
+    Trains several DynamicsModels, e.g. of different types, in parallel. Each model, including all of its
+    ensemble members, is trained in a single worker
+
+    Parameters:
+        models: the DynamicsModels to train
+        datasets: the training dataset of each model
+        cfgs: the configuration of each model
+        processes: the maximum number of worker processes
+
+    Returns:
+        the train and test logs of each model, as returned by DynamicsModel.train
+    """
+    memo = {}
+    jobs = [(model, share(dataset, memo), cfg) for model, dataset, cfg in zip(models, datasets, cfgs)]
+    with make_pool(min(processes, len(jobs))) as pool:
+        results = pool.map(_train_model, jobs, chunksize=1)
+
+    logs = []
+    for model, (states, train_logs, test_logs) in zip(models, results):
+        for net, state in zip(model.nets, states):
+            net.load_state_dict(state)
+        model.acctrain, model.acctest = train_logs, test_logs
+        logs.append((train_logs, test_logs))
+    return logs
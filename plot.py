@@ -351,7 +351,8 @@ def plot_loss(train_logs, test_logs, cfg, save_loc=None, show=False, title=None)
                           row=1, col=1)
         return fig
 
-    if len(np.shape(train_logs)) > 1:
+    # Ensemble members can stop early after different numbers of epochs
+    if len(train_logs) and np.ndim(train_logs[0]) > 0:
         # ENSEMBLE
         for i, (train, test) in enumerate(zip(train_logs, test_logs)):
             fig = add_line(fig, train, type="Train", ind=i)
@@ -1,6 +1,7 @@
 import sys
 import warnings
 import os
+import copy
 
 import matplotlib.cbook
 
@@ -25,6 +26,7 @@ from envs import *
 from gym.wrappers import Monitor
 
 import hydra
+from omegaconf import OmegaConf
 import logging
 
 log = logging.getLogger(__name__)
@@ -33,12 +35,104 @@ from policy import PID
 from plot import plot_reacher, plot_loss, setup_plotting
 
 from dynamics_model import DynamicsModel
+from trajectory_store import TrajectorySet, TrajectoryWriter, load_trajectories, store_path, trajectory_source
+from dataset_cache import build_dataset
+from parallel_training import train_models
 
 
 ###########################################
 #                Datasets                 #
 ###########################################
 
+def _unrank_pairs(k, n):
+    """
+    Maps linear indices k into the row-major list of (i, j) pairs with 0 <= i < j < n
+    back to the pairs themselves
+    """
+    rows = np.arange(max(n - 1, 0))
+    starts = rows * (2 * n - rows - 1) // 2
+    i = np.searchsorted(starts, k, side='right') - 1
+    j = k - starts[i] + i + 1
+    return i, j
+
+
+def _rank_pairs(i, j, n):
+    """
+    Inverse of _unrank_pairs
+    """
+    return i * (2 * n - i - 1) // 2 + (j - i - 1)
+
+
+def horizon_weights(n, horizons='uniform'):
+    """
+    Returns the probabilities of the horizons j - i = 1, ..., n - 1 of trajectory dataset entries
+
+    Parameters:
+    -----------
+    n: the trajectory length
+    horizons: 'uniform' for every horizon equally likely, 'pairs' for the horizons of uniformly drawn (i, j)
+              pairs (long horizons are rare), 'inverse' for probabilities proportional to 1 / horizon,
+              or an array of n - 1 weights
+    """
+    h = np.arange(1, n)
+    if isinstance(horizons, str):
+        if horizons == 'uniform':
+            weights = np.ones(n - 1)
+        elif horizons == 'pairs':
+            weights = (n - h).astype(float)
+        elif horizons == 'inverse':
+            weights = 1. / h
+        else:
+            raise ValueError("Invalid horizon distribution: " + horizons)
+    else:
+        weights = np.asarray(horizons, dtype=float)
+        if weights.shape != (n - 1,):
+            raise ValueError("Expected %d horizon weights, got %d" % (n - 1, len(weights)))
+    return weights / weights.sum()
+
+
+def _traj_pair_indices(n, threshold=0.0):
+    """
+    Returns the (i, j) pairs with 0 <= i < j < n that survive dropping each pair with
+    probability threshold, in the same order as a nested loop over i and j.
+
+    Kept pairs are found by drawing the geometric gaps between them, so the cost scales
+    with the number of kept pairs rather than with n^2.
+    """
+    num_pairs = n * (n - 1) // 2
+    keep = 1.0 - threshold
+    if num_pairs == 0 or keep <= 0:
+        k = np.zeros(0, dtype=np.int64)
+    elif keep >= 1:
+        k = np.arange(num_pairs)
+    else:
+        # The gaps between successes of a Bernoulli(keep) sequence are Geometric(keep)
+        chunks = []
+        last = -1
+        while last < num_pairs:
+            size = int((num_pairs - last) * keep * 1.1) + 16
+            positions = last + np.cumsum(np.random.geometric(keep, size=size))
+            chunks.append(positions)
+            last = positions[-1]
+        k = np.concatenate(chunks)
+        k = k[k < num_pairs]
+    return _unrank_pairs(k, n)
+
+
+def _traj_params(sequence, control_params=True, train_target=True):
+    """
+    Returns the constant per-trajectory columns of a trajectory dataset entry
+    """
+    params = []
+    if control_params:
+        params.extend([sequence.P, sequence.D])
+    if train_target:
+        params.append(sequence.target)
+    if not params:
+        return np.zeros(0)
+    return np.hstack(params)
+
+
 def create_dataset_traj(data, control_params=True, train_target=True, threshold=0.0, delta=False, t_range=0):
     """
     Creates a dataset with entries for PID parameters and number of
@@ -49,74 +143,195 @@ def create_dataset_traj(data, control_params=True, train_target=True, threshold=
     data: An array of dotmaps where each dotmap has info about a trajectory
     threshold: the probability of dropping a given data entry
     """
-    data_in, data_out = [], []
+    # Pick the kept (i, j) pairs of every trajectory first so the outputs can be preallocated
+    entries = []
     for sequence in data:
         states = sequence.states
         if t_range:
             states = states[:t_range]
-        P = sequence.P
-        D = sequence.D
-        target = sequence.target
-        n = states.shape[0]
-        for i in range(n):  # From one state p
-            for j in range(i + 1, n):
-                # This creates an entry for a given state concatenated
-                # with a number t of time steps as well as the PID parameters
-
-                # The randomely continuing is something I thought of to shrink
-                # the datasets while still having a large variety
-                if np.random.random() < threshold:
-                    continue
-                dat = [states[i], j - i]
-                if control_params:
-                    dat.extend([P, D])
-                if train_target:
-                    dat.append(target)
-                data_in.append(np.hstack(dat))
-                # data_in.append(np.hstack((states[i], j-i, target)))
-                if delta:
-                    data_out.append(states[j]-states[i])
-                else:
-                    data_out.append(states[j])
-
-    data_in = np.array(data_in)
-    data_out = np.array(data_out)
+        i, j = _traj_pair_indices(states.shape[0], threshold)
+        entries.append((states, _traj_params(sequence, control_params, train_target), i, j))
+
+    if not entries:
+        return np.array([]), np.array([])
+
+    state_size = entries[0][0].shape[1]
+    param_size = entries[0][1].shape[0]
+    n_rows = sum(len(i) for _, _, i, _ in entries)
+    dtype = np.result_type(*[states.dtype for states, _, _, _ in entries], np.float64)
+    data_in = np.empty((n_rows, state_size + 1 + param_size), dtype=dtype)
+    data_out = np.empty((n_rows, state_size), dtype=dtype)
+
+    # Each entry is a state concatenated with a number j - i of time steps as well as the PID parameters
+    row = 0
+    for states, params, i, j in entries:
+        end = row + len(i)
+        data_in[row:end, :state_size] = states[i]
+        data_in[row:end, state_size] = j - i
+        data_in[row:end, state_size + 1:] = params
+        if delta:
+            np.subtract(states[j], states[i], out=data_out[row:end])
+        else:
+            data_out[row:end] = states[j]
+        row = end
 
     return data_in, data_out
 
 
+class TrajectoryPairDataset(torch.utils.data.Dataset):
+    """
+    Lazy version of create_dataset_traj. Only the raw trajectories are stored, as
+    contiguous NxTxD arrays, and the [states[i], j - i, P, D, target] -> states[j]
+    entries are assembled on the fly.
+
+    Entries are addressed by a linear index over every (trajectory, i, j) pair, and
+    indexing with an array of indices returns a whole batch at once, so training can
+    draw from the full N*T^2/2 pair space with N*T*D memory.
+    """
+
+    def __init__(self, data, control_params=True, train_target=True, delta=False, t_range=0):
+        """
+        :param data: An array of dotmaps where each dotmap has info about a trajectory
+        """
+        states = [sequence.states[:t_range] if t_range else sequence.states for sequence in data]
+        self.states = np.ascontiguousarray(np.stack(states))
+        self.params = np.ascontiguousarray(
+            np.stack([_traj_params(sequence, control_params, train_target) for sequence in data]))
+        self.delta = delta
+
+    @property
+    def num_traj(self):
+        return self.states.shape[0]
+
+    @property
+    def pairs_per_traj(self):
+        T = self.states.shape[1]
+        return T * (T - 1) // 2
+
+    def __len__(self):
+        return self.num_traj * self.pairs_per_traj
+
+    def __getitem__(self, index):
+        traj, k = np.divmod(np.asarray(index), self.pairs_per_traj)
+        i, j = _unrank_pairs(k, self.states.shape[1])
+        data_in = np.concatenate((self.states[traj, i],
+                                  np.expand_dims(j - i, -1).astype(self.states.dtype),
+                                  self.params[traj]), axis=-1)
+        if self.delta:
+            data_out = self.states[traj, j] - self.states[traj, i]
+        else:
+            data_out = self.states[traj, j]
+        return data_in, data_out
+
+    def horizon_indices(self, budget, horizons='uniform'):
+        """
+        Draws exactly budget entries: a trajectory uniformly, a horizon j - i from the given distribution
+        (see horizon_weights) and then a start i uniformly among those that fit. Returns their indices,
+        sorted so entries of one trajectory stay together
+        """
+        T = self.states.shape[1]
+        traj = np.random.randint(0, self.num_traj, budget)
+        h = 1 + np.random.choice(T - 1, budget, p=horizon_weights(T, horizons))
+        i = (np.random.random(budget) * (T - h)).astype(np.int64)
+        return np.sort(traj * self.pairs_per_traj + _rank_pairs(i, i + h, T))
+
+    def _view(self, states, params):
+        dataset = TrajectoryPairDataset.__new__(TrajectoryPairDataset)
+        dataset.states = np.ascontiguousarray(states)
+        dataset.params = params
+        dataset.delta = self.delta
+        return dataset
+
+    def select(self, state_indices):
+        """
+        Returns a dataset that only uses the given state indices for inputs and outputs
+        """
+        return self._view(self.states[:, :, state_indices], self.params)
+
+    def subset(self, traj_indices):
+        """
+        Returns a dataset built from only the given trajectories
+        """
+        return self._view(self.states[traj_indices], self.params[traj_indices])
+
+
+def create_dataset_traj_budget(data, budget, horizons='uniform', control_params=True, train_target=True,
+                               delta=False, t_range=0):
+    """
+    Creates a trajectory dataset like create_dataset_traj, but with exactly budget entries whose horizons
+    j - i follow a chosen distribution, instead of randomly dropping entries of every pair
+
+    Parameters:
+    -----------
+    data: An array of dotmaps where each dotmap has info about a trajectory
+    budget: the number of entries
+    horizons: the distribution of horizons, see horizon_weights
+    """
+    dataset = TrajectoryPairDataset(data, control_params=control_params, train_target=train_target, delta=delta,
+                                    t_range=t_range)
+    return dataset[dataset.horizon_indices(budget, horizons)]
+
+
+def stack_trajectories(data):
+    """
+    Stacks equal length trajectories into a (states, actions) tuple of NxTxD and NxTxA
+    arrays, the format create_dataset_step can slice without copying. actions is None
+    for trajectories without actions
+    """
+    if isinstance(data, TrajectorySet):
+        # Stores already hold the stacked columns, memory-mapped
+        return data.states, data.actions if 'actions' in data.columns else None
+    states = np.stack([sequence.states for sequence in data])
+    if all('actions' in sequence for sequence in data):
+        return states, np.stack([sequence.actions for sequence in data])
+    return states, None
+
+
 def create_dataset_step(data, delta=True, t_range=0):
     """
     Creates a dataset for learning how one state progresses to the next
 
     Parameters:
     -----------
-    data: A 2d np array. Each row is a state
+    data: An array of dotmaps where each dotmap has info about a trajectory, or trajectories
+          already stacked as an NxTxD states array or a (states, actions) tuple (see
+          stack_trajectories). Stacked arrays are only sliced, so sweeps over t_range can
+          reuse the same buffers
     """
-    data_in = []
-    data_out = []
-    for sequence in data:
-        states = sequence.states
-        if t_range:
-            states = states[:t_range]
-        for i in range(states.shape[0] - 1):
-            if 'actions' in sequence.keys():
-                actions = sequence.actions
-                if t_range:
-                    actions = actions[:t_range]
-                data_in.append(np.hstack((states[i], actions[i])))
-                if delta:
-                    data_out.append(states[i + 1] - states[i])
-                else:
-                    data_out.append(states[i + 1])
-            else:
-                data_in.append(np.array(states[i]))
-                if delta:
-                    data_out.append(states[i + 1] - states[i])
-                else:
-                    data_out.append(states[i + 1])
-    data_in = np.array(data_in)
-    data_out = np.array(data_out)
+    if isinstance(data, np.ndarray):
+        batches = [(data, None)]
+    elif isinstance(data, tuple):
+        batches = [data]
+    else:
+        batches = [(sequence.states[None], sequence.actions[None] if 'actions' in sequence else None)
+                   for sequence in data]
+
+    if not batches:
+        # No trajectories, so the sizes of the entries are unknown
+        return np.empty((0, 0)), np.empty((0, 0))
+    if t_range:
+        batches = [(states[:, :t_range], None if actions is None else actions[:, :t_range])
+                   for states, actions in batches]
+
+    state_size = batches[0][0].shape[2]
+    action_size = 0 if batches[0][1] is None else batches[0][1].shape[2]
+    n_rows = sum(states.shape[0] * (states.shape[1] - 1) for states, _ in batches)
+    data_in = np.empty((n_rows, state_size + action_size), dtype=np.result_type(batches[0][0], np.float64))
+    data_out = np.empty((n_rows, state_size), dtype=data_in.dtype)
+
+    # Each entry pairs states[i] (and actions[i]) with states[i + 1], written straight from strided slices
+    row = 0
+    for states, actions in batches:
+        end = row + states.shape[0] * (states.shape[1] - 1)
+        current = states[:, :-1].reshape(-1, state_size)
+        data_in[row:end, :state_size] = current
+        if action_size:
+            data_in[row:end, state_size:] = actions[:, :-1].reshape(-1, action_size)
+        if delta:
+            np.subtract(states[:, 1:].reshape(-1, state_size), current, out=data_out[row:end])
+        else:
+            data_out[row:end] = states[:, 1:].reshape(-1, state_size)
+        row = end
 
     return data_in, data_out
 
@@ -165,11 +380,15 @@ def run_controller(env, horizon, policy, video = False):
     return logs
 
 
-def collect_data(cfg, plot=False):  # Creates horizon^2/2 points
+def collect_data(cfg, plot=False, writer=None, seed=0):  # Creates horizon^2/2 points
     """
     Collect data for environment model
     :param nTrials:
     :param horizon:
+    :param writer: an optional TrajectoryWriter. Each trajectory is written to it as soon as it finishes
+        instead of being kept in memory, and trials it already holds are skipped
+    :param seed: seeds the PID parameters and targets. Trial i only depends on seed and i, so skipping
+        finished trials does not change the others
     :return: an array of DotMaps, where each DotMap contains info about a trajectory
     """
 
@@ -184,24 +403,28 @@ def collect_data(cfg, plot=False):  # Creates horizon^2/2 points
     # about <horizon> steps with actions, rewards and states
     logs = []
     if (cfg.PID_test):
-        target = np.random.rand(5) * 2 - 1
+        target = np.random.RandomState(seed).rand(5) * 2 - 1
     for i in range(cfg.num_trials):
+        if writer is not None and i in writer:
+            log.info('Trial %d already collected' % i)
+            continue
         log.info('Trial %d' % i)
         if (cfg.PID_test):
             env.seed(0)
         else:
             env.seed(i)
         s0 = env.reset()
+        rng = np.random.RandomState([seed, i])
 
         # P = np.array([4, 4, 1, 1, 1])
-        P = np.random.rand(5) * 5
+        P = rng.rand(5) * 5
         I = np.zeros(5)
         # D = np.array([0.2, 0.2, 2, 0.4, 0.4])
-        D = np.random.rand(5)
+        D = rng.rand(5)
 
         # Samples target uniformely from [-1, 1]
         if (not cfg.PID_test):
-            target = np.random.rand(5) * 2 - 1
+            target = rng.rand(5) * 2 - 1
 
         policy = PID(dX=5, dU=5, P=P, I=I, D=D, target=target)
         # print(type(env))
@@ -211,7 +434,13 @@ def collect_data(cfg, plot=False):  # Creates horizon^2/2 points
         dotmap.P = P / 5
         dotmap.I = I
         dotmap.D = D
-        logs.append(dotmap)
+        if writer is not None:
+            writer.write(i, dotmap)
+        else:
+            logs.append(dotmap)
+
+    if writer is not None:
+        logs = writer.trajectories()
 
     if plot:
         import plotly.graph_objects as go
@@ -289,66 +518,165 @@ def log_hyperparams(cfg):
 #             Main Functions              #
 ###########################################
 
+def model_overrides(model, defaults):
+    """
+    Returns the entries of the model configuration model that differ from defaults, as a nested dictionary
+    """
+    overrides = {}
+    for key, value in model.items():
+        default = defaults.get(key)
+        if isinstance(value, dict) and isinstance(default, dict):
+            nested = model_overrides(value, default)
+            if nested:
+                overrides[key] = nested
+        elif key not in defaults or value != default:
+            overrides[key] = value
+    return overrides
+
+
+def model_config(cfg, name):
+    """
+    Returns a copy of cfg with its model replaced by the model configuration conf/models/<name>.yaml. Settings
+    of cfg.model that differ from its own conf/models file, e.g. overrides given on the command line, are
+    applied to the new model too
+    """
+    model_cfg = copy.deepcopy(cfg)
+    if name == cfg.model.str:
+        return model_cfg
+    models_dir = hydra.utils.get_original_cwd() + '/conf/models/'
+    defaults = OmegaConf.to_container(OmegaConf.load(models_dir + '%s.yaml' % cfg.model.str).model, resolve=True)
+    overrides = model_overrides(OmegaConf.to_container(cfg.model, resolve=True), defaults)
+    model = OmegaConf.load(models_dir + '%s.yaml' % name).model
+    model_cfg.model = OmegaConf.merge(model, OmegaConf.create(overrides))
+    return model_cfg
+
+
+def training_dataset(cfg, exper_data, data_file=None):
+    """
+    Builds the training dataset of the model configured in cfg.model from the trajectories exper_data,
+    through the dataset cache if they were loaded from data_file
+    """
+    traj = cfg.model.traj
+    if cfg.training.num_traj:
+        train_data = exper_data[:cfg.training.num_traj]
+    else:
+        train_data = exper_data
+
+    if traj and cfg.training.lazy_dataset:
+        return TrajectoryPairDataset(exper_data, control_params=cfg.model.training.control_params,
+                                     train_target=cfg.model.training.train_target)
+    elif traj and cfg.training.budget:
+        return build_dataset(cfg, create_dataset_traj_budget, exper_data, data_file, data_key={'split': 'train'},
+                             budget=cfg.training.budget, horizons=cfg.training.horizons,
+                             control_params=cfg.model.training.control_params,
+                             train_target=cfg.model.training.train_target)
+    elif traj:
+        return build_dataset(cfg, create_dataset_traj, exper_data, data_file, data_key={'split': 'train'},
+                             control_params=cfg.model.training.control_params,
+                             train_target=cfg.model.training.train_target, threshold=0.95)
+    else:
+        return build_dataset(cfg, create_dataset_step, train_data, data_file,
+                             data_key={'split': 'train', 'num_traj': cfg.training.num_traj}, delta=cfg.model.delta)
+
+
+def update_model(cfg, model, new_data, old_data=None):
+    """
+    Folds the trajectories new_data into a trained model with DynamicsModel.update, replaying entries of the
+    trajectories old_data it was trained on
+
+    Returns:
+        the train and test logs of the fine-tuning
+    """
+    if cfg.training.lazy_dataset:
+        raise ValueError("Models are updated from materialized datasets, set training.lazy_dataset to false")
+    replay = None if old_data is None else training_dataset(cfg, old_data)
+    return model.update(training_dataset(cfg, new_data), cfg, replay=replay)
+
+
+def update(cfg):
+    """
+    Loads the saved model and the trajectories it was trained on, folds in the trajectories of cfg.update_dir
+    and saves the updated model in its place
+    """
+    path = hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw'
+    (exper_data, _) = load_trajectories(path + cfg.data_dir)
+    (new_data, _) = load_trajectories(path + cfg.update_dir)
+
+    f = hydra.utils.get_original_cwd() + '/models/reacher/'
+    if cfg.exper_dir:
+        f = f + cfg.exper_dir + '/'
+    f = f + cfg.model.str + '.dat'
+    model = torch.load(f)
+
+    log.info(f"Updating model {cfg.model.str} with {len(new_data)} new trajectories")
+    train_logs, test_logs = update_model(cfg, model, new_data, exper_data)
+
+    setup_plotting({cfg.model.str: model})
+    plot_loss(train_logs, test_logs, cfg, save_loc=cfg.env.name + '-' + cfg.model.str + '-update', show=False)
+    torch.save(model, f)
+
+
 @hydra.main(config_path='conf/train.yaml')
 def contpred(cfg):
 
+    if cfg.mode == 'update':
+        return update(cfg)
+
     train = cfg.mode == 'train'
 
     # Collect data
     if not train:
         log.info(f"Collecting new trials")
 
-        exper_data = collect_data(cfg)
-        test_data = collect_data(cfg)
-
-        log.info("Saving new default data")
-        torch.save((exper_data, test_data),
-                   hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw' + cfg.data_dir)
-        log.info(f"Saved trajectories to {'/trajectories/reacher/' + 'raw' + cfg.data_dir}")
+        # Trajectories are saved as they finish, and a restarted collection resumes where it stopped
+        path = store_path(hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw' + cfg.data_dir)
+        log.info(f"Saving trajectories to {path}")
+        # A store collected with other settings is not resumed or reused
+        params = {'env': cfg.env.name, 'trial_timesteps': cfg.trial_timesteps, 'PID_test': cfg.PID_test}
+        train_writer = TrajectoryWriter(path, 'train', cfg.num_trials, params=dict(params, seed=0))
+        test_writer = TrajectoryWriter(path, 'test', cfg.num_trials, params=dict(params, seed=1))
+        exper_data = collect_data(cfg, writer=train_writer, seed=0)
+        test_data = collect_data(cfg, writer=test_writer, seed=1)
     # Load data
     else:
         log.info(f"Loading default data")
         # raise ValueError("Current Saved data old format")
         # Todo re-save data
-        (exper_data, test_data) = torch.load(
+        (exper_data, test_data) = load_trajectories(
             hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw' + cfg.data_dir)
 
     if train:
-        prob = cfg.model.prob
-        traj = cfg.model.traj
-        ens = cfg.model.ensemble
-        delta = cfg.model.delta
-
-        log.info(f"Training model P:{prob}, T:{traj}, E:{ens}")
-
-        log_hyperparams(cfg)
-
-        if cfg.training.num_traj:
-            train_data = exper_data[:cfg.training.num_traj]
-        else:
-            train_data = exper_data
-
-        if traj:
-            dataset = create_dataset_traj(exper_data, control_params=cfg.model.training.control_params,
-                                          train_target=cfg.model.training.train_target, threshold=0.95)
+        # Several model types can be trained at once, each with its own dataset
+        cfgs = [model_config(cfg, name) for name in cfg.train_models] if cfg.train_models else [cfg]
+
+        data_file = trajectory_source(hydra.utils.get_original_cwd() + '/trajectories/reacher/' + 'raw' + cfg.data_dir)
+        models, datasets = [], []
+        for model_cfg in cfgs:
+            log.info(f"Training model P:{model_cfg.model.prob}, T:{model_cfg.model.traj}, E:{model_cfg.model.ensemble}")
+            log_hyperparams(model_cfg)
+            datasets.append(training_dataset(model_cfg, exper_data, data_file))
+            models.append(DynamicsModel(model_cfg))
+
+        processes = cfg.training.processes
+        if len(models) > 1 and processes > 1:
+            logs = train_models(models, datasets, cfgs, processes)
         else:
-            dataset = create_dataset_step(train_data, delta=delta)
-
-        model = DynamicsModel(cfg)
-        train_logs, test_logs = model.train(dataset, cfg)
-
-        setup_plotting({cfg.model.str: model})
-        plot_loss(train_logs, test_logs, cfg, save_loc=cfg.env.name + '-' + cfg.model.str, show=False)
-
-        log.info("Saving new default models")
-        f =  hydra.utils.get_original_cwd() + '/models/reacher/'
-        if cfg.exper_dir:
-            f = f + cfg.exper_dir + '/'
-            if not os.path.exists(f):
-                os.mkdir(f)
-        f = f + cfg.model.str + '.dat'
-        torch.save(model, f)
-        # torch.save(model, "%s_backup.dat" % cfg.model.str) # save backup regardless
+            logs = [model.train(dataset, model_cfg, processes=processes)
+                    for model, dataset, model_cfg in zip(models, datasets, cfgs)]
+
+        for model_cfg, model, (train_logs, test_logs) in zip(cfgs, models, logs):
+            setup_plotting({model_cfg.model.str: model})
+            plot_loss(train_logs, test_logs, model_cfg, save_loc=cfg.env.name + '-' + model_cfg.model.str, show=False)
+
+            log.info("Saving new default models")
+            f =  hydra.utils.get_original_cwd() + '/models/reacher/'
+            if cfg.exper_dir:
+                f = f + cfg.exper_dir + '/'
+                if not os.path.exists(f):
+                    os.mkdir(f)
+            f = f + model_cfg.model.str + '.dat'
+            torch.save(model, f)
+            # torch.save(model, "%s_backup.dat" % cfg.model.str) # save backup regardless
 
 
 
@@ -0,0 +1,107 @@
+"""
+Per-epoch training telemetry, written as JSON lines.
+
+Every epoch of every net appends a record like
+    {"model": "de", "member": 2, "epoch": 4, "samples": 40000, "samples_per_sec": 51234.1,
+     "data_wait_s": 0.21, "compute_s": 0.57, "validation_s": 0.03, "peak_memory_mb": 812.4,
+     "train_loss": 0.0312, "val_loss": 0.0355, "lr": 5e-05}
+to the telemetry file, by default telemetry.jsonl in the run's (hydra output) directory. Epochs are numbered
+from 1 by every trainer, so the files of different trainers can be compared directly. data_wait_s is
+the time spent waiting for the next training batch, compute_s the rest of the training time (forward,
+backward and optimizer step), and peak_memory_mb the peak resident memory of the training process so far.
+Ensemble members trained together as stacked nets share their timings, with a record for each member.
+"""
+
+import os
+import sys
+import json
+import resource
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+import torch
+
+
+def peak_memory_mb():
+    """
+    Returns the peak memory of this process in MB, or of the GPU if one is in use
+    """
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class Telemetry(object):
+    """
+    Times the training epochs of a net and appends a record for each of them to a JSON lines file
+    """
+
+    def __init__(self, path=None, **context):
+        """
+        :param path: the file to append the records to, nothing is written if None
+        :param context: fields added to every record, e.g. model='de', member=2
+        """
+        self.path = path
+        self.context = context
+        self.start_epoch()
+
+    @staticmethod
+    def from_config(cfg, **context):
+        path = cfg.model.optimizer.telemetry
+        # Absolute, so records land in the same file from worker processes
+        return Telemetry(os.path.abspath(path) if path else None, **context)
+
+    def start_epoch(self):
+        self.start = timer()
+        self.data_wait = 0.
+        self.validation = 0.
+        self.samples = 0
+
+    def batches(self, loader):
+        """
+        Iterates over the batches of loader, timing how long each of them takes to arrive
+        """
+        iterator = iter(loader)
+        while True:
+            start = timer()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.data_wait += timer() - start
+            # Batches hold B entries, or B entries for each of the members of stacked nets
+            self.samples += batch[1].shape[-2]
+            yield batch
+
+    @contextmanager
+    def validating(self):
+        """
+        Times the validation in this context separately from training
+        """
+        start = timer()
+        yield
+        self.validation += timer() - start
+
+    def end_epoch(self, epoch, train_loss, val_loss, **fields):
+        """
+        Writes the record of an epoch, numbered from 1, with any extra fields, and starts timing the next one.
+        For stacked nets train_loss and val_loss are lists with the losses of each member
+        """
+        if self.path:
+            train_time = timer() - self.start - self.validation
+            record = dict(self.context)
+            record.update(epoch=epoch, samples=self.samples, samples_per_sec=self.samples / max(train_time, 1e-9),
+                          data_wait_s=self.data_wait, compute_s=train_time - self.data_wait,
+                          validation_s=self.validation, peak_memory_mb=peak_memory_mb())
+            record.update(fields)
+
+            if isinstance(train_loss, list):
+                records = [dict(record, member=e, train_loss=t, val_loss=v)
+                           for e, (t, v) in enumerate(zip(train_loss, val_loss))]
+            else:
+                records = [dict(record, train_loss=float(train_loss), val_loss=float(val_loss))]
+            with open(self.path, 'a') as f:
+                f.write(''.join(json.dumps(r) + '\n' for r in records))
+        self.start_epoch()
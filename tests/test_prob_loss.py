@@ -0,0 +1,55 @@
+"""
+Checks the linear-time ProbLoss against the trace-based loss it replaced
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dynamics_model import ProbLoss
+
+
+def trace_loss(loss_fn, inputs, targets):
+    """
+    The loss as computed before, with the log variance bounds of log(1 + exp(x)) and the BxB trace
+    """
+    mean = inputs[:, :loss_fn.size]
+    logvar = inputs[:, loss_fn.size:]
+    logvar = loss_fn.max_logvar - torch.log(1 + torch.exp(loss_fn.max_logvar - logvar))
+    logvar = loss_fn.min_logvar + torch.log(1 + torch.exp(logvar - loss_fn.min_logvar))
+    var = torch.exp(logvar)
+    diff = mean - targets
+    return torch.trace(torch.mm(diff, (diff / var).t())) + torch.sum(torch.log(var))
+
+
+@pytest.mark.parametrize('batch', [1, 32, 1024])
+def test_matches_trace_loss(batch):
+    torch.manual_seed(batch)
+    size = 7
+    loss_fn = ProbLoss(size)
+    with torch.no_grad():
+        loss_fn.max_logvar.uniform_(.5, 1.5)
+        loss_fn.min_logvar.uniform_(-1.5, -.5)
+    inputs = torch.randn(batch, 2 * size, dtype=torch.float64) * 2
+    targets = torch.randn(batch, size, dtype=torch.float64)
+
+    new_inputs = inputs.clone().requires_grad_()
+    old_inputs = inputs.clone().requires_grad_()
+    new = loss_fn(new_inputs, targets)
+    old = trace_loss(loss_fn, old_inputs, targets)
+    new.backward()
+    old.backward()
+
+    np.testing.assert_allclose(new.item(), old.item(), rtol=1e-5)
+    np.testing.assert_allclose(new_inputs.grad.numpy(), old_inputs.grad.numpy(), rtol=1e-4, atol=1e-6)
+
+
+def test_finite_for_large_log_variances():
+    loss_fn = ProbLoss(3)
+    inputs = torch.cat([torch.zeros(4, 3), torch.full((4, 3), 1000.)], 1)
+    assert torch.isfinite(loss_fn(inputs, torch.ones(4, 3)))
@@ -0,0 +1,286 @@
+"""
+Memory-mapped columnar storage for collected trajectories.
+
+A store is a directory next to the raw torch.save file it replaces (raw<name>.dat -> raw<name>.traj) holding
+    header.json            index of the splits (e.g. train / test), their columns, shapes and dtypes
+    <split>.<column>.npy   one array per column, with the trajectory index as the first dimension
+Sequence columns (states, actions, rewards) are NxTx... arrays and parameter columns (P, D, I, target) are
+small Nx... arrays. Opening a store only reads the header and memory-maps the columns, so accessing
+trajectory k does not read any of the others.
+
+Stores can also be filled one trajectory at a time with a TrajectoryWriter. Until every slot of a split
+is written, its header lists the completed trajectories and only those are visible when opening it. The
+header also records the parameters the split was collected with, and writers refuse to resume or reuse a
+split collected with different ones.
+
+To convert existing raw files run:
+    python trajectory_store.py trajectories/reacher/rawl500_t100_v1.dat [...]
+"""
+
+import os
+import sys
+import json
+
+import numpy as np
+from dotmap import DotMap
+
+import logging
+
+log = logging.getLogger(__name__)
+
+SEQUENCE_COLUMNS = ('states', 'actions', 'rewards')
+PARAM_COLUMNS = ('P', 'D', 'I', 'target')
+HEADER = 'header.json'
+
+
+def store_path(raw_path):
+    """
+    Returns the store directory corresponding to a raw trajectory file
+    """
+    return os.path.splitext(raw_path)[0] + '.traj'
+
+
+def _column_file(path, split, column):
+    return os.path.join(path, '%s.%s.npy' % (split, column))
+
+
+def read_header(path):
+    with open(os.path.join(path, HEADER)) as f:
+        return json.load(f)
+
+
+def write_header(path, header):
+    """
+    Writes the header atomically, so a crash never leaves a store with a partial index
+    """
+    tmp = os.path.join(path, HEADER + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(header, f, indent=2)
+    os.replace(tmp, os.path.join(path, HEADER))
+
+
+class TrajectorySet(object):
+    """
+    Read-only, list-like view of the trajectories in one split of a store. Indexing returns a DotMap
+    whose entries are memory-mapped views, and slicing returns another TrajectorySet.
+    """
+
+    def __init__(self, columns, indices=None):
+        """
+        :param columns: a dictionary of column name -> array with the trajectory index as the first dimension
+        :param indices: the trajectories of the columns that are part of this set, all of them by default
+        """
+        self.columns = columns
+        n = len(next(iter(columns.values()))) if columns else 0
+        self.indices = np.arange(n) if indices is None else np.asarray(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return TrajectorySet(self.columns, self.indices[k])
+        k = self.indices[k]
+        traj = DotMap()
+        for name, column in self.columns.items():
+            traj[name] = column[k]
+        return traj
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def column(self, name):
+        """
+        Returns one column for all the trajectories of this set, e.g. the NxTxD states array.
+        This is a view without copying whenever the set is a contiguous range of the store
+        """
+        column = self.columns[name]
+        if len(self.indices) and np.array_equal(self.indices, np.arange(self.indices[0], self.indices[-1] + 1)):
+            return column[self.indices[0]:self.indices[-1] + 1]
+        return column[self.indices]
+
+    @property
+    def states(self):
+        return self.column('states')
+
+    @property
+    def actions(self):
+        return self.column('actions')
+
+
+def open_store(path, mmap_mode='r'):
+    """
+    Opens a store written by save_trajectories
+
+    Returns:
+        the TrajectorySet of each split, as a tuple if the store was saved from a tuple
+    """
+    header = read_header(path)
+    splits = []
+    for split in header['splits']:
+        columns = {column: np.load(_column_file(path, split, column), mmap_mode=mmap_mode)
+                   for column in header['splits'][split]['columns']}
+        completed = header['splits'][split].get('completed')
+        splits.append(TrajectorySet(columns, None if completed is None else sorted(completed)))
+    if header['tuple']:
+        return tuple(splits)
+    return splits[0]
+
+
+def _columns_of(traj):
+    return [c for c in SEQUENCE_COLUMNS + PARAM_COLUMNS if c in traj]
+
+
+def save_trajectories(path, data):
+    """
+    Saves trajectories as a store
+
+    Parameters:
+        path: the store directory
+        data: a list of DotMaps, one per trajectory, or a tuple of such lists (e.g. (train, test))
+    """
+    as_tuple = isinstance(data, tuple)
+    splits = data if as_tuple else (data,)
+    if not as_tuple:
+        names = ['data']
+    elif len(splits) == 2:
+        names = ['train', 'test']
+    else:
+        names = ['split%d' % i for i in range(len(splits))]
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    header = {'version': 1, 'tuple': as_tuple, 'splits': {}}
+    for name, split in zip(names, splits):
+        columns = {}
+        for column in _columns_of(split[0]) if len(split) else []:
+            array = np.stack([np.asarray(traj[column]) for traj in split])
+            np.save(_column_file(path, name, column), array)
+            columns[column] = {'shape': list(array.shape), 'dtype': array.dtype.str}
+        header['splits'][name] = {'num_traj': len(split), 'columns': columns}
+    write_header(path, header)
+
+
+class TrajectoryWriter(object):
+    """
+    Writes the trajectories of one split of a store as they finish. The columns are preallocated,
+    memory-mapped files with a slot for each of the num_traj trajectories, and the header records which
+    slots are complete. Reopening a partially written split resumes it, so finished trajectories can be
+    skipped.
+    """
+
+    def __init__(self, path, split, num_traj, as_tuple=True, params=None):
+        """
+        :param path: the store directory
+        :param split: the name of the split to write, e.g. 'train'
+        :param num_traj: the number of trajectories the split will hold
+        :param as_tuple: whether open_store returns the splits of this store as a tuple
+        :param params: the parameters the trajectories are collected with, e.g. {'trial_timesteps': 500}, as
+            JSON-serializable values. Reopening a split that was collected with different ones raises ValueError
+        """
+        self.path = path
+        self.split = split
+        self.num_traj = num_traj
+        self.columns = {}
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if os.path.exists(os.path.join(path, HEADER)):
+            header = read_header(path)
+        else:
+            header = {'version': 1, 'tuple': as_tuple, 'splits': {}}
+
+        # Compared as stored, e.g. with tuples as lists
+        params = json.loads(json.dumps(params or {}))
+        if split in header['splits']:
+            entry = header['splits'][split]
+            if entry['num_traj'] != num_traj:
+                raise ValueError("Split %s of %s holds %d trajectories, not %d"
+                                 % (split, path, entry['num_traj'], num_traj))
+            # Stores written before parameters were recorded are not checked
+            if entry.get('params', params) != params:
+                raise ValueError("Split %s of %s was collected with %s, not %s. Remove the store or collect to "
+                                 "another one" % (split, path, entry['params'], params))
+            self.completed = set(entry.get('completed', range(num_traj)))
+            self.columns = {column: np.load(_column_file(path, split, column), mmap_mode='r+')
+                            for column in entry['columns']}
+        else:
+            self.completed = set()
+            header['splits'][split] = {'num_traj': num_traj, 'columns': {}, 'completed': [], 'params': params}
+            write_header(path, header)
+
+    def __contains__(self, k):
+        return k in self.completed
+
+    def write(self, k, traj):
+        """
+        Writes traj, a DotMap with the trajectory's columns, to slot k and marks it complete
+        """
+        if not self.columns:
+            for column in _columns_of(traj):
+                value = np.asarray(traj[column])
+                self.columns[column] = np.lib.format.open_memmap(
+                    _column_file(self.path, self.split, column), mode='w+', dtype=value.dtype,
+                    shape=(self.num_traj,) + value.shape)
+
+        for column, array in self.columns.items():
+            array[k] = traj[column]
+            array.flush()
+        self.completed.add(k)
+
+        # The other splits may have been written in the meantime, so only this entry is replaced
+        header = read_header(self.path)
+        entry = header['splits'][self.split]
+        entry['columns'] = {column: {'shape': list(array.shape), 'dtype': array.dtype.str}
+                            for column, array in self.columns.items()}
+        if len(self.completed) == self.num_traj:
+            entry.pop('completed', None)
+        else:
+            entry['completed'] = sorted(self.completed)
+        write_header(self.path, header)
+
+    def trajectories(self):
+        """
+        Returns the completed trajectories as a TrajectorySet
+        """
+        return TrajectorySet(self.columns, sorted(self.completed))
+
+
+def trajectory_source(raw_path):
+    """
+    Returns the store of raw_path if one exists and otherwise raw_path itself
+    """
+    path = store_path(raw_path)
+    if os.path.exists(os.path.join(path, HEADER)):
+        return path
+    return raw_path
+
+
+def load_trajectories(raw_path):
+    """
+    Loads trajectories saved under raw_path, from its store if one exists and otherwise from the raw
+    torch.save file
+    """
+    path = trajectory_source(raw_path)
+    if path != raw_path:
+        return open_store(path)
+    import torch
+    return torch.load(raw_path)
+
+
+def convert(raw_path):
+    """
+    Converts a raw torch.save trajectory file to a store next to it
+    """
+    import torch
+    path = store_path(raw_path)
+    save_trajectories(path, torch.load(raw_path))
+    return path
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    for raw in sys.argv[1:]:
+        log.info("Converted %s to %s" % (raw, convert(raw)))